@@ -0,0 +1,183 @@
+# -*- coding: utf-8 -*-
+
+# Copyright 2026 The atrope contributors
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import datetime
+import re
+import threading
+import time
+
+from oslo_config import cfg
+
+from atrope import exception
+
+opts = [
+    cfg.IntOpt('max_bandwidth',
+               default=0,
+               min=0,
+               help='Maximum bandwidth (in bytes per second) used by all '
+                    'the image downloads together. Set it to 0 for no '
+                    'limit.'),
+    cfg.IntOpt('max_bandwidth_per_host',
+               default=0,
+               min=0,
+               help='Maximum bandwidth (in bytes per second) used by the '
+                    'image downloads from the same host. Set it to 0 for '
+                    'no limit.'),
+    cfg.DictOpt('host_max_bandwidth',
+                default={},
+                help='Maximum bandwidth (in bytes per second) for the image '
+                     'downloads from specific hosts, overriding '
+                     'max_bandwidth_per_host. For example: '
+                     '"appdb.example.org:1048576,localhost:0".'),
+    cfg.ListOpt('bandwidth_schedule',
+                default=[],
+                help='Time of day profiles for the global bandwidth limit, '
+                     'as a list of START-END=RATE items, with START and END '
+                     'in HH:MM local time and RATE in bytes per second (0 '
+                     'means no limit). While a profile is active its rate '
+                     'is used instead of max_bandwidth. For example: '
+                     '"08:00-20:00=10485760" limits the downloads to 10 MiB/s '
+                     'during business hours.'),
+]
+
+CONF = cfg.CONF
+CONF.register_opts(opts, group="http")
+
+_LIMITER = None
+_LIMITER_LOCK = threading.Lock()
+
+
+class TokenBucket(object):
+    """Token bucket, where each token allows to transfer one byte.
+
+    The bucket is filled at "rate" tokens per second, and it can hold up to
+    one second worth of tokens. Consumers are allowed to go in debt, and then
+    they wait until the debt has been paid, so that a block larger than the
+    bucket can be transferred.
+    """
+
+    def __init__(self, rate):
+        self.rate = rate
+        self.tokens = rate
+        self.last = time.monotonic()
+        self.lock = threading.Lock()
+
+    def consume(self, amount, rate=None):
+        """Take tokens from the bucket, sleeping if there are not enough.
+
+        :param amount: number of tokens to take.
+        :param rate: if set, the new fill rate of the bucket.
+        """
+        with self.lock:
+            if rate is not None and rate != self.rate:
+                self.rate = rate
+                self.tokens = min(self.tokens, rate)
+            if not self.rate:
+                return
+            now = time.monotonic()
+            self.tokens = min(self.rate,
+                              self.tokens + (now - self.last) * self.rate)
+            self.last = now
+            self.tokens -= amount
+            delay = -self.tokens / self.rate
+        if delay > 0:
+            time.sleep(delay)
+
+
+def _parse_host_limits(limits):
+    hosts = {}
+    for host, rate in limits.items():
+        try:
+            hosts[host] = int(rate)
+        except ValueError:
+            hosts[host] = -1
+        if hosts[host] < 0:
+            raise exception.InvalidBandwidthLimit(host=host, value=rate)
+    return hosts
+
+
+def _parse_schedule(schedule):
+    profiles = []
+    for item in schedule:
+        match = re.match(r"^(\d{1,2}):(\d{2})-(\d{1,2}):(\d{2})=(\d+)$",
+                         item.strip())
+        if match is None:
+            raise exception.InvalidBandwidthSchedule(
+                item=item, reason="format is HH:MM-HH:MM=RATE")
+        h1, m1, h2, m2, rate = [int(i) for i in match.groups()]
+        if h1 > 23 or h2 > 23 or m1 > 59 or m2 > 59:
+            raise exception.InvalidBandwidthSchedule(
+                item=item, reason="invalid time")
+        profiles.append((h1 * 60 + m1, h2 * 60 + m2, rate))
+    return profiles
+
+
+class BandwidthLimiter(object):
+    """Limit the bandwidth used by the downloads, globally and per host."""
+
+    def __init__(self, max_bandwidth, max_bandwidth_per_host,
+                 host_max_bandwidth, schedule):
+        self.max_bandwidth = max_bandwidth
+        self.max_bandwidth_per_host = max_bandwidth_per_host
+        self.host_max_bandwidth = _parse_host_limits(host_max_bandwidth)
+        self.schedule = _parse_schedule(schedule)
+
+        self.bucket = TokenBucket(self.get_rate())
+        self.hosts = {}
+        self.lock = threading.Lock()
+
+    def get_rate(self, now=None):
+        """Get the global rate that applies at a given time (default now)."""
+        now = now or datetime.datetime.now()
+        minute = now.hour * 60 + now.minute
+        for start, end, rate in self.schedule:
+            if start <= end:
+                active = start <= minute < end
+            else:
+                active = minute >= start or minute < end
+            if active:
+                return rate
+        return self.max_bandwidth
+
+    def _get_host_bucket(self, host):
+        with self.lock:
+            if host not in self.hosts:
+                rate = self.host_max_bandwidth.get(
+                    host, self.max_bandwidth_per_host)
+                self.hosts[host] = TokenBucket(rate)
+            return self.hosts[host]
+
+    def throttle(self, host, amount):
+        """Account for bytes downloaded from a host, sleeping if needed."""
+        self._get_host_bucket(host).consume(amount)
+        self.bucket.consume(amount, rate=self.get_rate())
+
+
+def get_limiter():
+    """Get the process wide bandwidth limiter.
+
+    :raises: exception.InvalidBandwidthSchedule or
+             exception.InvalidBandwidthLimit if the options are not valid.
+    """
+    global _LIMITER
+
+    with _LIMITER_LOCK:
+        if _LIMITER is None:
+            _LIMITER = BandwidthLimiter(CONF.http.max_bandwidth,
+                                        CONF.http.max_bandwidth_per_host,
+                                        CONF.http.host_max_bandwidth,
+                                        CONF.http.bandwidth_schedule)
+    return _LIMITER
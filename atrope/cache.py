@@ -14,12 +14,24 @@
 # License for the specific language governing permissions and limitations
 # under the License.
 
+import collections
+import contextlib
+from concurrent import futures
+import functools
+import operator
+import os
 import pathlib
+import shutil
+import time
+import urllib.parse
 
 from oslo_config import cfg
 from oslo_log import log
 
+import atrope.dispatcher.manager
 from atrope import exception
+from atrope import manifest
+from atrope import mirrors
 from atrope import paths
 from atrope import utils
 
@@ -27,6 +39,59 @@ opts = [
     cfg.StrOpt('path',
                default=paths.state_path_def('lists'),
                help='Where instances are stored on disk'),
+    cfg.IntOpt('download_workers',
+               default=4,
+               min=1,
+               help='Maximum number of images that will be downloaded '
+                    'concurrently.'),
+    cfg.IntOpt('download_workers_per_host',
+               default=2,
+               min=1,
+               help='Maximum number of images that will be downloaded '
+                    'concurrently from the same host.'),
+    cfg.IntOpt('download_max_wait',
+               default=600,
+               min=0,
+               help='Images are downloaded by the priority of their list, '
+                    'and then smallest first. Downloads that have been '
+                    'pending for more than this number of seconds, counting '
+                    'the previous runs where they were deferred, are '
+                    'started before any other, so that large images are '
+                    'not delayed indefinitely. Set it to 0 to disable it.'),
+    cfg.IntOpt('min_free_space',
+               default=0,
+               min=0,
+               help='Free space (in bytes) that will be kept on the cache '
+                    'filesystem. Downloads that would not fit are deferred '
+                    'to the next run.'),
+    cfg.IntOpt('max_size',
+               default=0,
+               min=0,
+               help='Maximum size (in bytes) of the image cache. When it is '
+                    'exceeded, images that are already present in all the '
+                    'dispatchers are evicted from the cache, and they will '
+                    'only be downloaded again if they need to be '
+                    'dispatched again. Set it to 0 for no limit.'),
+    cfg.StrOpt('eviction_policy',
+               default='lru',
+               choices=[
+                   ('lru', 'Evict first the images that were dispatched '
+                           'longest ago.'),
+                   ('largest', 'Evict first the largest images.'),
+               ],
+               help='Which images are evicted first when the cache exceeds '
+                    'max_size.'),
+    cfg.IntOpt('verify_workers',
+               min=1,
+               help='Maximum number of cached images whose checksum will be '
+                    'verified concurrently. Defaults to the number of CPUs.'),
+    cfg.IntOpt('lock_timeout',
+               min=0,
+               help='Number of seconds to wait for a list or an image that '
+                    'is being processed by another atrope process. When it '
+                    'expires the list or image is skipped until the next '
+                    'run. Set it to 0 to skip them immediately. By default '
+                    'wait indefinitely.'),
 ]
 
 CONF = cfg.CONF
@@ -35,60 +100,677 @@ CONF.register_opts(opts, group="cache")
 LOG = log.getLogger(__name__)
 
 
+class BlobStore(object):
+    """Content addressed store for the cached images.
+
+    Images are stored once, keyed by their SHA-512 checksum, and the images
+    of each list are hardlinks to them. Therefore an image that appears in
+    several lists is only downloaded and stored once, and a blob that is not
+    linked from any list (i.e. its link count is 1) can be removed.
+
+    :param path: directory where the blobs are stored.
+    :param lock: callable returning a context manager that locks the image
+                 with a given checksum, yielding whether it was locked.
+    """
+
+    def __init__(self, path, lock):
+        self.path = path
+        self.lock = lock
+
+    def get_location(self, sha512):
+        return self.path / sha512[:2] / sha512
+
+    def link(self, img, imgdir):
+        """Link a stored copy of an image into a directory.
+
+        :returns: True if the image was stored and has been linked, False
+                  otherwise.
+        """
+        blob = self.get_location(img.sha512)
+        if not blob.exists():
+            return False
+
+        if CONF.paranoid or not img.check_fingerprint(blob):
+            try:
+                img.verify_checksum(location=blob)
+            except exception.ImageVerificationFailed:
+                LOG.warning(f"Stored blob '{blob}' is not valid, removing it")
+                self._remove(blob)
+                return False
+
+        location = pathlib.Path(imgdir) / img.identifier
+        utils.rm(location)
+        os.link(blob, location)
+        img.save_fingerprint(location)
+        img.verified = True
+        LOG.info(f"Image '{img.identifier}' linked from '{blob}'")
+        return True
+
+    def add(self, img):
+        """Store a downloaded image, replacing the stored copy if needed."""
+        blob = self.get_location(img.sha512)
+        try:
+            if blob.exists() and os.path.samefile(blob, img.location):
+                return
+        except OSError:
+            pass
+
+        utils.makedirs(blob.parent)
+        tmp = blob.with_name(f".{blob.name}.tmp")
+        utils.rm(tmp)
+        os.link(img.location, tmp)
+        os.replace(tmp, blob)
+        img.save_fingerprint(blob)
+
+    def _remove(self, blob):
+        utils.rm(blob)
+        manifest.get_manifest().delete_file(blob)
+
+    def remove(self, sha512):
+        """Remove a blob from the store."""
+        self._remove(self.get_location(sha512))
+
+    def gc(self, dry_run=False):
+        """Remove the blobs that are not linked from any list.
+
+        :param dry_run: only report the blobs that would be removed.
+        """
+        if not self.path.exists():
+            return
+
+        for blob in self.path.glob("*/*"):
+            if blob.name.startswith("."):
+                continue
+            # NOTE: do not wait for images that are being linked or
+            # downloaded by another process, they are not unreferenced.
+            with self.lock(blob.name, wait=False) as locked:
+                try:
+                    if not locked or blob.stat().st_nlink != 1:
+                        continue
+                except FileNotFoundError:
+                    continue
+                if dry_run:
+                    LOG.warning(f"Would remove unreferenced blob '{blob}' "
+                                "from cache.")
+                else:
+                    LOG.info(f"Removing unreferenced blob '{blob}' from "
+                             "cache.")
+                    self._remove(blob)
+
+
+class ImageDownload(object):
+    """A pending image download, as seen by the download scheduler.
+
+    Downloads are ordered by the priority of their list (higher first) and
+    then by their size (smaller first), in order to minimise the mean time
+    until the images are available. Downloads that have been pending for
+    more than CONF.cache.download_max_wait seconds, including previous runs
+    where they were deferred, are started first, so that large images are
+    not delayed indefinitely.
+    """
+
+    __slots__ = ("img", "imgdir", "priority", "size", "host", "queued")
+
+    def __init__(self, img, imgdir, priority, size, queued=None):
+        self.img = img
+        self.imgdir = imgdir
+        self.priority = priority
+        self.size = size
+        # NOTE: the image is downloaded from its best mirror, so
+        # count the download against the host of that mirror.
+        url = mirrors.get_stats().sort(img.mirrors + [img.uri])[0]
+        self.host = urllib.parse.urlparse(url).netloc
+        # NOTE: this is the time when the image was first queued,
+        # stored in the manifest, so it is wall-clock time.
+        self.queued = time.time() if queued is None else queued
+
+    def get_key(self, now=None):
+        max_wait = CONF.cache.download_max_wait
+        now = now or time.time()
+        waited = max_wait and now - self.queued >= max_wait
+        return (not waited, -self.priority, self.size)
+
+
 class CacheManager(object):
+    """Manage the images cached on disk.
+
+    Several atrope processes can share the same cache, as it is protected
+    with advisory locks: each list is locked while its images are verified,
+    downloaded, cleaned and dispatched, each image (bucketed by checksum)
+    is locked while it is linked from or stored into the blob store, and
+    the whole cache is locked in shared mode while lists are processed, and
+    exclusively while it is swept, garbage collected and evicted.
+    """
+
     def __init__(self):
         self.path = pathlib.Path(CONF.cache.path)
         utils.makedirs(self.path)  # FIXME
-        self._valid_paths = [self.path]
+        self._valid_paths = set()
+        self._add_valid_path(self.path)
+        self.locks_path = self.path / ".locks"
+        utils.makedirs(self.locks_path)
+        self._add_valid_path(self.locks_path)
+        self.blobs = BlobStore(self.path / ".blobs", self._lock_image)
+        self._add_valid_path(self.blobs.path)
+
+    def _add_valid_path(self, path):
+        self._valid_paths.add(os.fspath(path))
+
+    def _lock(self, name, shared=False, wait=True):
+        timeout = CONF.cache.lock_timeout if wait else 0
+        return utils.file_lock(self.locks_path / name, shared=shared,
+                               timeout=timeout)
+
+    def _lock_cache(self, shared=False):
+        return self._lock("cache", shared=shared)
+
+    def _lock_list(self, lst):
+        return self._lock(f"list-{lst.name}")
 
-    def _download_list(self, lst):
+    def _lock_image(self, sha512, wait=True):
+        # NOTE: images are locked in buckets, so that the number of
+        # lock files is bounded and they never need to be removed.
+        return self._lock(f"image-{sha512[:2]}", wait=wait)
+
+    def _prepare_list(self, lst, dry_run=False):
+        """Verify the cached images of a list.
+
+        :param dry_run: do not link images from the blob store.
+
+        :returns: a tuple (images, imgdir) with the subscribed images of the
+                  list and the directory where they are stored, or None if
+                  the images of the list should not be cached.
+        """
         LOG.info(f"Syncing list with ID '{lst.name}'")
-        if lst.enabled:
-            LOG.info(f"List '{lst.name}' is enabled, checking if downloaded "
-                     "images are valid")
-            basedir = self.path / lst.name
-            imgdir = basedir / 'images'
-            if lst.trusted and lst.verified and not lst.expired:
-                utils.makedirs(imgdir)  # FIXME(aloga) pathlib
-                self._valid_paths.append(basedir)
-                self._valid_paths.append(imgdir)
-                for img in lst.get_subscribed_images():
+        if not lst.enabled:
+            LOG.info(f"List '{lst.name}' is disabled, images will be "
+                     "marked for removal")
+            return None
+
+        LOG.info(f"List '{lst.name}' is enabled, checking if downloaded "
+                 "images are valid")
+        basedir = self.path / lst.name
+        imgdir = basedir / 'images'
+        if not (lst.trusted and lst.verified and not lst.expired):
+            return None
+
+        if not dry_run:
+            utils.makedirs(imgdir)  # FIXME(aloga) pathlib
+        self._add_valid_path(basedir)
+        self._add_valid_path(imgdir)
+
+        images = lst.get_subscribed_images()
+        self.verify_images(images, imgdir, dry_run=dry_run)
+        return images, imgdir
+
+    def _download_lists(self, lists, dry_run=False):
+        """Download the images of several lists.
+
+        All the downloads are scheduled together, so that the images of the
+        lists with a higher priority are downloaded first.
+
+        :param dry_run: do not download any image, only report them.
+        """
+        prepared = []
+        downloads = []
+        for lst in sorted(lists, key=lambda lst: -lst.priority):
+            aux = self._prepare_list(lst, dry_run=dry_run)
+            if aux is None:
+                if not dry_run:
+                    manifest.get_manifest().set_pending(lst.name, [])
+                continue
+            images, imgdir = aux
+            prepared.append(aux)
+            evicted = {}
+            if CONF.cache.max_size:
+                evicted = atrope.dispatcher.manager.get_dispatched(lst, images)
+            pending = []
+            for img in images:
+                if img.verified:
                     try:
                         img.download(imgdir)
+                    except exception.ImageAlreadyDownloaded:
+                        pass
+                elif img.identifier in evicted:
+                    # NOTE: the image is not in the cache, but it is
+                    # already present in all the dispatchers, so it is still
+                    # valid and there is no need to download it again.
+                    LOG.debug(f"Image '{img.identifier}' has been evicted "
+                              "from the cache and it is already dispatched, "
+                              "not downloading it")
+                    img.verified = True
+                else:
+                    pending.append(img)
+
+            if dry_run:
+                for img in pending:
+                    LOG.warning(f"Would download image '{img.identifier}' "
+                                f"into '{imgdir}'")
+                continue
+            queued = manifest.get_manifest().set_pending(
+                lst.name, [img.identifier for img in pending])
+            for img in pending:
+                img.mirrors = mirrors.get_mirror_urls(img.uri, lst.mirrors)
+                try:
+                    downloads.append(ImageDownload(
+                        img, imgdir, lst.priority,
+                        self._get_needed_space(img, imgdir),
+                        queued[img.identifier]))
+                except (exception.AtropeException, ValueError) as e:
+                    LOG.error(f"Cannot schedule the download of image "
+                              f"'{img.identifier}': {e}")
+
+        admitted = self._plan_downloads(downloads)
+        self._download_images(admitted)
+
+        for images, imgdir in prepared:
+            for img in images:
+                if img.location is not None:
+                    self._add_valid_path(img.location)
+                else:
+                    # NOTE: keep interrupted downloads, so that they
+                    # can be resumed in the next run.
+                    partial = img.get_partial_location(imgdir)
+                    self._add_valid_path(partial)
+
+    def verify_images(self, images, imgdir, dry_run=False):
+        """Verify the cached copies of several images concurrently.
+
+        Hashing is done in a thread pool of CONF.cache.verify_workers
+        threads, as hashlib releases the GIL while hashing large blocks. The
+        result for each image is stored in its "verified" attribute.
+
+        :param dry_run: do not link the images that are missing from the
+                        blob store.
+
+        :returns: the images that are present in imgdir and are valid.
+        """
+        workers = CONF.cache.verify_workers or os.cpu_count() or 1
+        with futures.ThreadPoolExecutor(max_workers=workers) as executor:
+            jobs = {executor.submit(self._verify_image, img, imgdir,
+                                    dry_run): img
+                    for img in images}
+            valid = []
+            for job in futures.as_completed(jobs):
+                img = jobs[job]
+                try:
+                    if job.result():
+                        valid.append(img)
+                except (exception.AtropeException, OSError) as e:
+                    LOG.error(f"Cannot verify image '{img.identifier}': {e}")
+        return valid
+
+    def _verify_image(self, img, imgdir, dry_run=False):
+        if img.verify_cached(imgdir):
+            return True
+        if dry_run:
+            return False
+        with self._lock_image(img.sha512) as locked:
+            if not locked:
+                LOG.warning(f"Image '{img.identifier}' is locked by another "
+                            "process, not linking it from the blob store")
+                return False
+            return self.blobs.link(img, imgdir)
+
+    @staticmethod
+    def _get_needed_space(img, imgdir):
+        """Get the disk space that is still needed to download an image."""
+        if img.verified:
+            return 0
+        try:
+            partial = os.path.getsize(img.get_partial_location(imgdir))
+        except OSError:
+            partial = 0
+        return max(int(img.size) - partial, 0)
+
+    def _plan_downloads(self, downloads):
+        """Select the downloads that fit in the free space.
+
+        The space that is needed for each image is taken from its size in
+        the image list. Images that do not fit are deferred to the next run,
+        so that we do not fill the filesystem.
+
+        :returns: the downloads that can be done, in scheduling order.
+        """
+        available = (shutil.disk_usage(self.path).free -
+                     CONF.cache.min_free_space)
+        admitted = []
+        for dl in sorted(downloads, key=ImageDownload.get_key):
+            if dl.size <= available:
+                available -= dl.size
+                admitted.append(dl)
+            else:
+                LOG.error(f"Not enough disk space to download image "
+                          f"'{dl.img.identifier}' ({dl.size} bytes needed, "
+                          f"{max(available, 0)} available), deferring it")
+        return admitted
+
+    def _fetch_image(self, dl):
+        """Download an image and store it in the blob store.
+
+        :returns: True if the image has been downloaded, False if it is
+                  locked by another process.
+        """
+        with self._lock_image(dl.img.sha512) as locked:
+            if not locked:
+                LOG.warning(f"Image '{dl.img.identifier}' is locked by "
+                            "another process, deferring its download")
+                return False
+
+            # NOTE: the same image may have been downloaded for
+            # another list (or process) while this download was waiting.
+            try:
+                self.blobs.link(dl.img, dl.imgdir)
+            except OSError as e:
+                LOG.warning(f"Cannot link image '{dl.img.identifier}' from "
+                            f"the blob store: {e}")
+
+        # NOTE: the image lock is shared by a bucket of checksums, so
+        # it is not held while downloading. The partial download belongs to
+        # the list directory, that is already locked.
+        dl.img.download(dl.imgdir)
+
+        with self._lock_image(dl.img.sha512) as locked:
+            if not locked:
+                LOG.warning(f"Image '{dl.img.identifier}' is locked by "
+                            "another process, not storing it in the blob "
+                            "store")
+                return True
+            try:
+                self.blobs.add(dl.img)
+            except OSError as e:
+                LOG.warning(f"Cannot store image '{dl.img.identifier}' in "
+                            f"the blob store: {e}")
+        return True
+
+    def _download_images(self, downloads):
+        """Download several images concurrently.
+
+        At most CONF.cache.download_workers images are processed at the same
+        time, at most CONF.cache.download_workers_per_host of them from the
+        same host, and images with the same checksum are not downloaded at
+        the same time. The pending downloads are started in the order given
+        by ImageDownload.get_key().
+
+        :returns: the images that have been successfully downloaded.
+        """
+        pending = list(downloads)
+        running = {}
+        per_host = collections.Counter()
+        digests = set()
+        downloaded = []
+
+        with futures.ThreadPoolExecutor(
+                max_workers=CONF.cache.download_workers) as executor:
+            while pending or running:
+                pending.sort(key=functools.partial(ImageDownload.get_key,
+                                                   now=time.time()))
+                for dl in list(pending):
+                    if len(running) >= CONF.cache.download_workers:
+                        break
+                    if (per_host[dl.host] >=
+                            CONF.cache.download_workers_per_host or
+                            dl.img.sha512 in digests):
+                        continue
+                    pending.remove(dl)
+                    per_host[dl.host] += 1
+                    digests.add(dl.img.sha512)
+                    job = executor.submit(self._fetch_image, dl)
+                    running[job] = dl
+
+                done, _ = futures.wait(running,
+                                       return_when=futures.FIRST_COMPLETED)
+                for job in done:
+                    dl = running.pop(job)
+                    per_host[dl.host] -= 1
+                    digests.discard(dl.img.sha512)
+                    try:
+                        if job.result():
+                            downloaded.append(dl.img)
                     except (exception.ImageVerificationFailed,
                             exception.ImageDownloadFailed):
-                        pass
-                    else:
-                        pass
-                        self._valid_paths.append(pathlib.Path(img.location))
+                        continue
+                    except (exception.AtropeException, OSError,
+                            ValueError) as e:
+                        LOG.error(f"Cannot download image "
+                                  f"'{dl.img.identifier}': {e}")
+
+        return downloaded
+
+    def get_size(self):
+        """Get the disk space used by the cache, counting hardlinks once."""
+        size = 0
+        seen = set()
+        pending = [os.fspath(self.path)]
+        while pending:
+            try:
+                with os.scandir(pending.pop()) as entries:
+                    for entry in entries:
+                        if entry.is_dir(follow_symlinks=False):
+                            pending.append(entry.path)
+                        elif entry.inode() not in seen:
+                            seen.add(entry.inode())
+                            size += entry.stat(follow_symlinks=False).st_size
+            except FileNotFoundError:
+                continue
+        return size
+
+    def evict(self, lists, dry_run=False):
+        """Evict images from the cache until it fits in CONF.cache.max_size.
+
+        The whole cache is locked while images are evicted.
+
+        :param dry_run: only report the images that would be evicted.
+        """
+        if not CONF.cache.max_size:
+            return
+        with self._lock_cache() as locked:
+            if not locked:
+                LOG.warning("The cache is locked by another process, not "
+                            "evicting images")
+                return
+            self._evict(lists, dry_run=dry_run)
+
+    def _evict(self, lists, dry_run=False):
+        """Evict images from the cache until it fits in CONF.cache.max_size.
+
+        Only images that are already present in all the dispatchers can be
+        evicted, and an image is only evicted if all the lists that contain
+        it (i.e. all the links to its blob) can evict it. Evicted images are
+        still considered valid, so they are not removed from the
+        dispatchers, and they will be downloaded again if they need to be
+        dispatched again.
+
+        :param dry_run: only report the images that would be evicted.
+        """
+        max_size = CONF.cache.max_size
+        if not max_size:
+            return
+        size = self.get_size()
+        if size <= max_size:
+            return
+
+        # NOTE: group the cached images by checksum, as the space is
+        # not freed until all the copies are removed.
+        groups = {}
+        for lst in lists:
+            images = [img for img in lst.get_subscribed_images()
+                      if img.location is not None]
+            dispatched = atrope.dispatcher.manager.get_dispatched(lst, images)
+            for img in images:
+                group = groups.setdefault(img.sha512, {"images": [],
+                                                       "evictable": True,
+                                                       "timestamp": 0,
+                                                       "size": int(img.size)})
+                group["images"].append(img)
+                if img.identifier in dispatched:
+                    group["timestamp"] = max(group["timestamp"],
+                                             dispatched[img.identifier])
+                else:
+                    group["evictable"] = False
+
+        candidates = [g for g in groups.values() if g["evictable"]]
+        if CONF.cache.eviction_policy == "largest":
+            candidates.sort(key=operator.itemgetter("size"), reverse=True)
         else:
-            LOG.info(f"List '{lst.name}' is disabled, images will be "
-                     "marked for removal")
+            candidates.sort(key=operator.itemgetter("timestamp"))
 
-    def _clean_invalid(self, base):
-        LOG.info(f"Checking for invalid files in cache dir ({base}).")
+        LOG.info(f"Cache size ({size} bytes) exceeds the maximum size "
+                 f"({max_size} bytes), evicting images")
+        for group in candidates:
+            if size <= max_size:
+                break
+            sha512 = group["images"][0].sha512
+            for img in group["images"]:
+                if dry_run:
+                    LOG.warning(f"Would evict image '{img.identifier}' "
+                                f"from '{img.location}'")
+                    continue
+                LOG.warning(f"Evicting image '{img.identifier}' from "
+                            f"'{img.location}'")
+                utils.rm(img.location)
+                self._valid_paths.discard(img.location)
+                img.location = None
+            if not dry_run:
+                self.blobs.remove(sha512)
+            size -= group["size"]
+
+        if size > max_size:
+            LOG.warning(f"Cache size ({size} bytes) exceeds the maximum "
+                        f"size ({max_size} bytes), but there are no more "
+                        "images that can be evicted")
+
+    def _find_invalid(self, base, keep=()):
+        """Find the paths below base that are not valid.
+
+        The tree is walked once, and invalid directories are not descended
+        into, as they will be removed with all their contents. The blob
+        store is not walked, as it is cleaned by BlobStore.gc(), and neither
+        are the lock files.
+
+        :param keep: paths that are kept as they are, without walking them.
+        """
         invalid_paths = []
+        pending = [os.fspath(base)]
+        skip = {os.fspath(self.blobs.path), os.fspath(self.locks_path)}
+        skip.update(os.fspath(path) for path in keep)
+        while pending:
+            try:
+                with os.scandir(pending.pop()) as entries:
+                    for entry in entries:
+                        if entry.path in skip:
+                            continue
+                        elif entry.path not in self._valid_paths:
+                            invalid_paths.append(entry.path)
+                        elif entry.is_dir(follow_symlinks=False):
+                            pending.append(entry.path)
+            except FileNotFoundError:
+                continue
+        return invalid_paths
+
+    def _clean_invalid(self, base, dry_run=False, keep=()):
+        """Remove the files below base that are not in the cache anymore.
 
-        for f in base.glob("**/*"):
-            if f not in self._valid_paths:
-                invalid_paths.append(f)
+        :param dry_run: only report the files that would be removed.
+        :param keep: paths that are kept as they are, without walking them.
+        """
+        LOG.info(f"Checking for invalid files in cache dir ({base}).")
+        invalid_paths = self._find_invalid(base, keep=keep)
 
         if not invalid_paths:
             LOG.info(f"No invalid files in cache dir ({base}).")
 
-        for i in invalid_paths:
-            LOG.warning(f"Removing '{i}' from cache.")
-            utils.rm(i)  # FIXME
+        for i in sorted(invalid_paths):
+            if dry_run:
+                LOG.warning(f"Would remove '{i}' from cache.")
+            else:
+                LOG.warning(f"Removing '{i}' from cache.")
+                utils.rm(i)  # FIXME
 
-    def sync_one(self, lst):
-        self._download_list(lst)
-        self._clean_invalid(self.path / lst.name)
+    def sync_one(self, lst, dry_run=False, dispatch=None):
+        """Sync the cached images of one list.
 
-    def sync(self, lists):
+        Several processes can sync different lists at the same time.
+
+        :param dry_run: do not download, remove or dispatch any image, only
+                        report them.
+        :param dispatch: if set, it is called with the list once its images
+                         are cached, while the list is still locked, so that
+                         a list is not dispatched by several processes at
+                         the same time.
+        :returns: False if the list was skipped because it is locked by
+                  another process, True otherwise.
+        """
+        with self._lock_cache(shared=True) as locked:
+            if not locked:
+                LOG.warning("The cache is locked by another process, "
+                            f"skipping list '{lst.name}'")
+                return False
+            with self._lock_list(lst) as locked:
+                if not locked:
+                    LOG.warning(f"List '{lst.name}' is locked by another "
+                                "process, skipping it")
+                    return False
+                self._download_lists([lst], dry_run=dry_run)
+                self._clean_invalid(self.path / lst.name, dry_run=dry_run)
+                if dispatch is not None and not dry_run:
+                    dispatch(lst)
+            self.blobs.gc(dry_run=dry_run)
+            if not dry_run:
+                manifest.get_manifest().prune_files()
+        return True
+
+    def sync(self, lists, dry_run=False):
+        """Sync the cached images of all the lists.
+
+        The images of all the lists are downloaded together, with each list
+        locked and the cache locked in shared mode, so that other processes
+        can sync other lists at the same time. Lists that are locked by
+        another process are skipped. Afterwards the whole cache is locked to
+        remove the lists that are not configured anymore, the unreferenced
+        blobs and the images that need to be evicted.
+
+        :param dry_run: do not download or remove any file, only report them.
+        :returns: False if the sync was skipped because the cache is locked
+                  by another process, True otherwise.
+        """
         LOG.info("Starting cache sync")
+        synced = []
+        with self._lock_cache(shared=True) as locked:
+            if not locked:
+                LOG.warning("The cache is locked by another process, "
+                            "skipping sync")
+                return False
 
-        for lst in lists.values():
-            self.sync_one(lst)
-        self._clean_invalid(self.path)
+            with contextlib.ExitStack() as stack:
+                # NOTE: lists are always locked in the same order, so that
+                # concurrent syncs cannot deadlock.
+                for lst in sorted(lists.values(), key=lambda lst: lst.name):
+                    if stack.enter_context(self._lock_list(lst)):
+                        synced.append(lst)
+                    else:
+                        LOG.warning(f"List '{lst.name}' is locked by another "
+                                    "process, skipping it")
+                self._download_lists(synced, dry_run=dry_run)
+                for lst in synced:
+                    self._clean_invalid(self.path / lst.name,
+                                        dry_run=dry_run)
 
+        with self._lock_cache() as locked:
+            if not locked:
+                LOG.warning("The cache is locked by another process, not "
+                            "cleaning it")
+                return True
+            # NOTE: the lists have been cleaned while they were locked, and
+            # they may have been synced again by another process since then,
+            # so only the lists that are not cached anymore are removed.
+            keep = [self.path / lst.name for lst in lists.values()
+                    if lst not in synced or
+                    os.fspath(self.path / lst.name) in self._valid_paths]
+            self._clean_invalid(self.path, dry_run=dry_run, keep=keep)
+            self.blobs.gc(dry_run=dry_run)
+            self._evict(synced, dry_run=dry_run)
+            if not dry_run:
+                manifest.get_manifest().prune_files()
         LOG.info("Sync completed")
+        return True
@@ -14,6 +14,7 @@
 # License for the specific language governing permissions and limitations
 # under the License.
 
+from atrope import bandwidth
 from atrope.cmd import base
 from atrope.image_list import manager
 from atrope import utils
@@ -21,6 +22,7 @@ from atrope import utils
 from oslo_config import cfg
 
 CONF = cfg.CONF
+CONF.import_opt("paranoid", "atrope.image")
 
 
 class BaseImageListCommand(base.BaseCommand):
@@ -35,6 +37,34 @@ class BaseImageListCommand(base.BaseCommand):
         return self._manager
 
 
+class BaseImageListCacheCommand(BaseImageListCommand):
+    def __init__(self, *args, **kwargs):
+        super(BaseImageListCacheCommand, self).__init__(*args, **kwargs)
+
+        self.parser.add_argument("--paranoid",
+                                 dest="verify_all",
+                                 default=False,
+                                 action="store_true",
+                                 help="Verify the checksum of all the cached "
+                                      "images, even if they have not been "
+                                      "modified since they were verified.")
+
+        self.parser.add_argument("--dry-run",
+                                 dest="dry_run",
+                                 default=False,
+                                 action="store_true",
+                                 help="Do not download, remove or dispatch "
+                                      "any image, only show what would be "
+                                      "done.")
+
+    def run(self):
+        if CONF.command.verify_all:
+            CONF.set_override("paranoid", True)
+        # NOTE: the bandwidth limits are checked before starting, so that
+        # invalid ones stop the command instead of failing every download.
+        bandwidth.get_limiter()
+
+
 class CommandImageListIndex(BaseImageListCommand):
     def __init__(self, parser, name="index",
                  cmd_help="Show the configured image lists."):
@@ -83,20 +113,22 @@ class CommandImageListFetch(BaseImageListCommand):
             lst.print_list(contents=show_contents)
 
 
-class CommandImageListCache(BaseImageListCommand):
+class CommandImageListCache(BaseImageListCacheCommand):
     def __init__(self, parser, name="cache",
                  cmd_help="Download images from configured image lists."):
         super(CommandImageListCache, self).__init__(parser, name, cmd_help)
 
     def run(self):
-        self.manager.cache()
+        super(CommandImageListCache, self).run()
+        self.manager.cache(dry_run=CONF.command.dry_run)
 
 
-class CommandDispatch(BaseImageListCommand):
+class CommandDispatch(BaseImageListCacheCommand):
     def __init__(self, parser, name="sync",
                  cmd_help="Download images from configured image lists "
                           "and sync them to the available dispatchers."):
         super(CommandDispatch, self).__init__(parser, name, cmd_help)
 
     def run(self):
-        self.manager.sync()
+        super(CommandDispatch, self).run()
+        self.manager.sync(dry_run=CONF.command.dry_run)
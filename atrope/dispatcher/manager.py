@@ -16,6 +16,7 @@ from oslo_config import cfg
 from oslo_log import log
 
 from atrope import exception
+from atrope.image_list import delta
 from atrope import importutils
 
 opts = [
@@ -37,19 +38,67 @@ LOG = log.getLogger(__name__)
 DISPATCHER_NAMESPACE = 'atrope.dispatcher'
 
 
+def _get_metadata(image_list, **kwargs):
+    """Get the extra metadata that is added to the images of a list."""
+    kwargs.setdefault("image_list", image_list.name)
+    kwargs.setdefault("project", image_list.project)
+
+    if image_list.image_list is not None:
+        if image_list.image_list.vo is not None:
+            kwargs["vo"] = image_list.image_list.vo
+    return kwargs
+
+
+def _get_tracker(image_list, dispatcher, is_public, metadata):
+    # NOTE: the configuration of the dispatchers is part of the
+    # tracked state, so that changing it dispatches all the images again.
+    return delta.DeltaTracker(
+        image_list.name, dispatcher,
+        config="%s %s %s %s" % (
+            CONF.dispatchers.prefix,
+            image_list.prefix,
+            is_public,
+            sorted(metadata.items())))
+
+
+def get_dispatched(image_list, images):
+    """Get the images that are already present in all the dispatchers.
+
+    :param image_list: the image list the images belong to.
+    :param images: the images to check.
+    :returns: a dictionary mapping the identifiers of the images that have
+              been successfully dispatched (and have not changed since then)
+              to the time when they were dispatched.
+    """
+    is_public = False if image_list.token else True
+    metadata = _get_metadata(image_list)
+    dispatched = None
+    for dispatcher in CONF.dispatchers.dispatcher:
+        tracker = _get_tracker(image_list, dispatcher, is_public, metadata)
+        timestamps = tracker.get_timestamps()
+        unchanged = tracker.diff(images).unchanged
+        if dispatched is None:
+            dispatched = {i: timestamps.get(i, 0) for i in unchanged}
+        else:
+            dispatched = {i: max(t, timestamps.get(i, 0))
+                          for i, t in dispatched.items() if i in unchanged}
+    return dispatched or {}
+
+
 class DispatcherManager(object):
     def __init__(self):
-        self.dispatchers = []
+        self.dispatchers = {}
         for dispatcher in CONF.dispatchers.dispatcher:
             cls_ = "%s.%s.Dispatcher" % (DISPATCHER_NAMESPACE, dispatcher)
-            self.dispatchers.append(importutils.import_class(cls_)())
+            self.dispatchers[dispatcher] = importutils.import_class(cls_)()
 
     def sync(self, image_list, **kwargs):
         """Sync the images from one list with the dispatchers.
 
         This method will dispatch all the images associated with the image
-        list. Afterwards it will remove any image associated to that image list
-        that was not set for dispatch (i.e. it will remove old images).
+        list that have been added or changed since the last sync. Afterwards
+        it will remove any image associated to that image list that was not
+        set for dispatch (i.e. it will remove old images).
         """
         self._dispatch_list(image_list, **kwargs)
         self._sync_list(image_list)
@@ -61,14 +110,15 @@ class DispatcherManager(object):
         in theory these methods should remove old images that were not
         dispached.
         """
-        for dispatcher in self.dispatchers:
+        for dispatcher in self.dispatchers.values():
             dispatcher.sync(image_list)
 
     def _dispatch_list(self, image_list, **kwargs):
         """Dispatch a list of images to each of the dispatchers.
 
-        This command will receive an image list and will dispatch all the
-        images into the catalog.
+        This command will receive an image list and will dispatch into the
+        catalog all the images that were added or changed since the last
+        time that the list was dispatched.
 
         :param image_list: image list to dispatch
         :param **kwargs: extra metadata to be added to the image.
@@ -76,15 +126,10 @@ class DispatcherManager(object):
 
         LOG.info("Preparing to dispatch list '%s''" % image_list.name)
 
-        kwargs.setdefault("image_list", image_list.name)
-        kwargs.setdefault("project", image_list.project)
+        kwargs = _get_metadata(image_list, **kwargs)
 
         is_public = False if image_list.token else True
 
-        if image_list.image_list is not None:
-            if image_list.image_list.vo is not None:
-                kwargs["vo"] = image_list.image_list.vo
-
         try:
             images = image_list.get_valid_subscribed_images()
         except exception.ImageListNotFetched:
@@ -92,19 +137,55 @@ class DispatcherManager(object):
                         "skipping dispatch.")
             images = []
 
+        trackers = {name: _get_tracker(image_list, name, is_public, kwargs)
+                    for name in self.dispatchers}
+        changes = {name: tracker.diff(images)
+                   for name, tracker in trackers.items()}
+        for name, change in changes.items():
+            LOG.info("List '%s' changes since last dispatch to '%s': %s",
+                     image_list.name, name, change)
+
+        dispatched = {name: [] for name in self.dispatchers}
         for image in images:
+            pending = set()
+            for name, change in changes.items():
+                if image.identifier in change.unchanged:
+                    dispatched[name].append(image)
+                else:
+                    pending.add(name)
+            if not pending:
+                LOG.debug("Image '%s' has not changed since it was "
+                          "dispatched, skipping", image.identifier)
+                continue
+
             image_name = ("%(global prefix)s%(list prefix)s%(image name)s" %
                           {"global prefix": CONF.dispatchers.prefix,
                            "list prefix": image_list.prefix,
                            "image name": image.title})
-            self._dispatch_image(image_name, image, is_public, **kwargs)
+            for name in self._dispatch_image(image_name, image, is_public,
+                                             pending, **kwargs):
+                dispatched[name].append(image)
+
+        if image_list.image_list is not None:
+            for name, tracker in trackers.items():
+                tracker.commit(dispatched[name])
 
-    def _dispatch_image(self, image_name, image, is_public, **kwargs):
-        """Dispatch a single image to each of the dispatchers."""
-        for dispatcher in self.dispatchers:
+    def _dispatch_image(self, image_name, image, is_public, dispatchers,
+                        **kwargs):
+        """Dispatch a single image to some of the dispatchers.
+
+        :param dispatchers: names of the dispatchers to use.
+        :returns: the names of the dispatchers that succeeded.
+        """
+        succeeded = set()
+        for name in dispatchers:
             try:
-                dispatcher.dispatch(image_name, image, is_public, **kwargs)
+                self.dispatchers[name].dispatch(image_name, image, is_public,
+                                                **kwargs)
             except Exception as e:
                 LOG.exception("An exception has occured when dispatching "
                               "image %s" % image.identifier)
                 LOG.exception(e)
+            else:
+                succeeded.add(name)
+        return succeeded
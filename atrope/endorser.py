@@ -14,6 +14,8 @@
 # License for the specific language governing permissions and limitations
 # under the License.
 
+import sys
+
 from atrope import exception
 
 
@@ -25,6 +27,8 @@ class Endorser(object):
         "hv:email",
     )
 
+    __slots__ = ("name", "dn", "ca", "email")
+
     def __init__(self, meta):
         # FIXME(aloga): DRY this
         meta = meta.get("hv:x509")
@@ -35,8 +39,8 @@ class Endorser(object):
             raise exception.InvalidImageList(reason=reason)
 
         self.name = meta["dc:creator"]
-        self.dn = meta["hv:dn"]
-        self.ca = meta["hv:ca"]
+        self.dn = sys.intern(meta["hv:dn"])
+        self.ca = sys.intern(meta["hv:ca"])
         self.email = meta["hv:email"]
 
     def __str__(self):
@@ -117,3 +117,15 @@ class MetadataOverwriteNotSupported(AtropeException):
 
 class GlanceInvalidMappingFIle(GlanceError):
     msg_fmt = "Cannot load %(file)s mapping file: %(reason)s."
+
+
+class InvalidBandwidthSchedule(AtropeException):
+    msg_fmt = "Invalid bandwidth schedule '%(item)s': %(reason)s"
+
+
+class InvalidBandwidthLimit(AtropeException):
+    msg_fmt = "Invalid bandwidth limit '%(value)s' for host '%(host)s'"
+
+
+class ManifestError(AtropeException):
+    msg_fmt = "Cannot access the state manifest %(path)s: %(reason)s"
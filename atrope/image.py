@@ -15,17 +15,30 @@
 # under the License.
 
 import abc
+from concurrent import futures
+import hashlib
 import os.path
+import re
+import sys
+import threading
+import time
+import urllib.parse
+import urllib.request
 
 from oslo_config import cfg
 from oslo_log import log
 import requests
 import requests.certs
 import six
+import urllib3
 
+from atrope import bandwidth
 from atrope import exception
+from atrope import manifest
+from atrope import mirrors
 from atrope import ovf
 from atrope import paths
+from atrope import session
 from atrope import utils
 
 opts = [
@@ -38,6 +51,33 @@ opts = [
                     'is done as there may be certificates signed by '
                     'CAs that are trusted by the provider, but untrusted '
                     'by the default bundle and we need to trust both.'),
+    cfg.IntOpt('io_block_size',
+               default=4 * 1024 * 1024,
+               min=4096,
+               help='Size (in bytes) of the buffer used when downloading, '
+                    'reading and calculating the checksum of the images. '
+                    'Larger buffers mean less system calls, at the cost of '
+                    'using more memory for each concurrent download.'),
+    cfg.IntOpt('segmented_download_threshold',
+               default=0,
+               min=0,
+               help='Images larger than this size (in bytes) will be '
+                    'downloaded using several connections in parallel, if '
+                    'the server supports range requests. If a segmented '
+                    'download fails, it is resumed using a single '
+                    'connection. Set it to 0 to disable segmented '
+                    'downloads.'),
+    cfg.IntOpt('download_segments',
+               default=4,
+               min=1,
+               help='Number of connections used for segmented downloads.'),
+    cfg.BoolOpt('paranoid',
+                default=False,
+                help='Verify the checksum of every cached image, even if '
+                     'it has not been modified since it was last verified. '
+                     'Otherwise the checksum is only calculated again if '
+                     'the size, modification time or inode of the file '
+                     'have changed.'),
 ]
 
 CONF = cfg.CONF
@@ -49,6 +89,8 @@ LOG = log.getLogger(__name__)
 
 @six.add_metaclass(abc.ABCMeta)
 class BaseImage(object):
+    __slots__ = ("uri", "sha512", "identifier", "location", "verified")
+
     @abc.abstractmethod
     def __init__(self, image_info):
         self.uri = None
@@ -104,16 +146,77 @@ class BaseImage(object):
         if location is None:
             raise exception.ImageNotFoundOnDisk(location=location)
 
-        sha512 = utils.get_file_checksum(location)
-        if sha512.hexdigest() != self.sha512:
+        sha512 = utils.get_file_checksum(location,
+                                         block_size=CONF.io_block_size)
+        self._check_checksum(sha512.hexdigest())
+        LOG.info("Image '%s' present in '%s', checksum OK",
+                 self.identifier, location)
+        self.verified = True
+        self.save_fingerprint(location)
+
+    def verify_cached(self, basedir):
+        """Check if there is a valid copy of the image in a directory.
+
+        The checksum is only calculated if the file has been modified since
+        it was last verified, unless CONF.paranoid is set. An invalid file is
+        removed, so that it is downloaded again.
+
+        :param basedir: directory where the image is stored.
+        :returns: True if the image is present and valid, False otherwise.
+        """
+        location = os.path.join(basedir, self.identifier)
+        if not os.path.exists(location):
+            self.verified = False
+        elif not CONF.paranoid and self.check_fingerprint(location):
+            LOG.debug("Image '%s' present in '%s' has not been modified "
+                      "since it was verified, skipping checksum",
+                      self.identifier, location)
+            self.verified = True
+        else:
+            try:
+                self.verify_checksum(location=location)
+            except exception.ImageVerificationFailed:
+                LOG.warning("Image '%s' present in '%s' is not valid, "
+                            "removing it", self.identifier, location)
+                manifest.get_manifest().delete_file(location)
+                utils.rm(location)
+                self.verified = False
+        return self.verified
+
+    @staticmethod
+    def _stat_fingerprint(location):
+        st = os.stat(location)
+        return (st.st_size, st.st_mtime_ns, st.st_ino)
+
+    def save_fingerprint(self, location):
+        """Record in the manifest that the file in location is valid.
+
+        The size, modification time and inode of the file are stored
+        together with the checksum, so that we do not need to calculate it
+        again while the file is not modified.
+        """
+        manifest.get_manifest().set_file(location, self.sha512,
+                                         *self._stat_fingerprint(location))
+
+    def check_fingerprint(self, location):
+        """Check if the file in location was already verified."""
+        row = manifest.get_manifest().get_file(location)
+        if row is None or row["sha512"] != self.sha512:
+            return False
+        try:
+            return ((row["size"], row["mtime_ns"], row["inode"]) ==
+                    self._stat_fingerprint(location))
+        except OSError:
+            return False
+
+    def _check_checksum(self, obtained):
+        """Check an obtained checksum against the image's checksum."""
+        if obtained != self.sha512:
             raise exception.ImageVerificationFailed(
                 id=self.identifier,
                 expected=self.sha512,
-                obtained=sha512.hexdigest()
+                obtained=obtained
             )
-        LOG.info("Image '%s' present in '%s', checksum OK",
-                 self.identifier, location)
-        self.verified = True
 
 
 class HepixImage(BaseImage):
@@ -139,75 +242,445 @@ class HepixImage(BaseImage):
         "sl:osversion": "osversion",
     }
     required_fields = field_map.keys()
+    # Values that are repeated across most of the images
+    interned_fields = (
+        "ad:group",
+        "hv:format",
+        "hv:hypervisor",
+        "hv:version",
+        "sl:arch",
+        "sl:os",
+        "sl:osname",
+        "sl:osversion",
+    )
+
+    __slots__ = tuple(sorted(set(field_map.values()) -
+                             set(BaseImage.__slots__))) + ("_extra",
+                                                           "mirrors")
 
     def __init__(self, image_info):
         super(HepixImage, self).__init__(image_info)
 
-        image_dict = image_info.get("hv:image", {})
+        image_dict = self.validate(image_info)
 
         utils.ensure_ca_bundle(CONF.download_ca_file,
                                [requests.certs.where()],
                                CONF.ca_path)
 
         for i in self.required_fields:
-            value = image_dict.get(i, None)
-            if value is None:
+            value = image_dict[i]
+            if i in self.interned_fields and isinstance(value, str):
+                value = sys.intern(value)
+            setattr(self, self.field_map[i], value)
+
+        self._extra = {sys.intern(k): v for k, v in image_dict.items()
+                       if k not in self.field_map}
+
+        # Other URLs where the image can be downloaded from
+        self.mirrors = []
+
+    @property
+    def appliance_attributes(self):
+        """Get the original HEPiX image definition.
+
+        Everything from HEPiX is added as 'extra', so that it can be queried
+        in glance.
+        """
+        attrs = {k: getattr(self, v) for k, v in self.field_map.items()}
+        attrs.update(self._extra)
+        return attrs
+
+    @classmethod
+    def validate(cls, image_info):
+        """Check that an image definition contains all the required fields.
+
+        :returns: the image definition.
+        :raises: exception.InvalidImageList if any field is missing.
+        """
+        image_dict = None
+        if isinstance(image_info, dict):
+            image_dict = image_info.get("hv:image", {})
+        if not isinstance(image_dict, dict):
+            reason = "Invalid image definition, it is not an object"
+            raise exception.InvalidImageList(reason=reason)
+        for i in cls.required_fields:
+            if image_dict.get(i, None) is None:
                 reason = "Invalid image definition, missing '%s'" % i
                 raise exception.InvalidImageList(reason=reason)
+        return image_dict
 
-            attr = self.field_map.get(i)
-            setattr(self, attr, value)
-        # add everything from hepix as 'extra', so it can be queried in glance
-        self.appliance_attributes = image_dict
+    def _get(self, url, headers=None):
+        try:
+            return session.get_session().get(url,
+                                             stream=True,
+                                             headers=headers,
+                                             verify=CONF.download_ca_file)
+        except Exception as e:
+            LOG.error(e)
+            raise exception.ImageDownloadFailed(code=e.errno,
+                                                reason=e)
+
+    @staticmethod
+    def _resumes_at(response, offset):
+        """Check if a response contains the image starting at offset."""
+        if response.status_code != 206:
+            return False
+        match = re.match(r"bytes (\d+)-",
+                         response.headers.get("Content-Range", ""))
+        return match is not None and int(match.group(1)) == offset
+
+    def _get_ranges_url(self, url):
+        """Check if the image can be downloaded in several segments.
+
+        :returns: the (final) URL of the image if the image is larger than
+                  CONF.segmented_download_threshold and the server supports
+                  range requests, None otherwise.
+        """
+        threshold = CONF.segmented_download_threshold
+        if (not threshold or CONF.download_segments < 2 or
+                int(self.size) < threshold or url.startswith("file:")):
+            return None
 
-    def _download(self, location):
-        LOG.info("Downloading image '%s' from '%s' into '%s'",
-                 self.identifier, self.uri, location)
-        with open(location, 'wb') as f:
+        try:
+            response = session.get_session().head(
+                url, allow_redirects=True, verify=CONF.download_ca_file)
+        except requests.exceptions.RequestException as e:
+            LOG.debug("Cannot check if server supports range requests for "
+                      "image '%s': %s", self.identifier, e)
+            return None
+
+        if (response.ok and
+                response.headers.get("Accept-Ranges") == "bytes" and
+                response.headers.get("Content-Length") == str(self.size)):
+            return response.url
+        LOG.debug("Server does not support range requests for image '%s', "
+                  "using a single stream", self.identifier)
+        return None
+
+    def _download_segment(self, url, fd, start, end, abort, written):
+        """Download the bytes [start, end] of the image into fd.
+
+        The position up to which the segment has been written is stored in
+        written[start].
+        """
+        response = self._get(url,
+                             headers={"Range": "bytes=%d-%d" % (start, end)})
+        with response:
+            if not self._resumes_at(response, start):
+                raise exception.ImageDownloadFailed(
+                    code=response.status_code,
+                    reason="invalid response to range request")
+
+            response.raw.decode_content = True
+            limiter = bandwidth.get_limiter()
+            host = urllib.parse.urlparse(url).netloc
+            pos = start
             try:
-                response = requests.get(self.uri, stream=True,
-                                        verify=CONF.download_ca_file)
-            except Exception as e:
-                LOG.error(e)
-                raise exception.ImageDownloadFailed(code=e.errno,
-                                                    reason=e)
-
-            if not response.ok:
-                LOG.error("Cannot download image: (%s) %s",
-                          response.status_code, response.reason)
-                raise exception.ImageDownloadFailed(code=response.status_code,
-                                                    reason=response.reason)
-
-            for block in response.iter_content(1024):
-                if block:
+                for block in utils.read_blocks(response.raw,
+                                               CONF.io_block_size):
+                    if abort.is_set():
+                        return
+                    if pos + len(block) > end + 1:
+                        raise exception.ImageDownloadFailed(
+                            code=None,
+                            reason="image is larger than its advertised size")
+                    limiter.throttle(host, len(block))
+                    while block:
+                        count = os.pwrite(fd, block, pos)
+                        pos += count
+                        block = block[count:]
+                        written[start] = pos
+            except (requests.exceptions.RequestException,
+                    urllib3.exceptions.HTTPError, OSError) as e:
+                raise exception.ImageDownloadFailed(code=None, reason=e)
+
+        if pos != end + 1:
+            raise exception.ImageDownloadFailed(
+                code=None, reason="incomplete segment %d-%d" % (start, end))
+
+    def _download_segmented(self, url, location, partial):
+        """Download the image using several connections.
+
+        Each of the connections downloads a range of the image, writing it
+        directly into its position in a (preallocated) segments file, that is
+        renamed into the partial file once all of them have been downloaded.
+        Since this file is not written sequentially, if any of the segments
+        fails only the data written by the first one is kept as the partial
+        file, so that the download can be resumed using a single connection.
+
+        :returns: the SHA-512 digest of the downloaded image.
+        """
+        size = int(self.size)
+        segments = CONF.download_segments
+        segment_size = -(-size // segments)
+        segmented = self.get_segments_location(os.path.dirname(location))
+        LOG.info("Downloading image '%s' from '%s' into '%s' using %d "
+                 "segments", self.identifier, url, location, segments)
+
+        abort = threading.Event()
+        written = {}
+        with open(segmented, "wb") as f:
+            try:
+                utils.preallocate(f.fileno(), size)
+            except OSError as e:
+                utils.rm(segmented)
+                raise exception.ImageDownloadFailed(code=e.errno, reason=e)
+
+            try:
+                with futures.ThreadPoolExecutor(
+                        max_workers=segments) as executor:
+                    jobs = []
+                    for start in range(0, size, segment_size):
+                        end = min(start + segment_size, size) - 1
+                        jobs.append(executor.submit(self._download_segment,
+                                                    url, f.fileno(),
+                                                    start, end, abort,
+                                                    written))
+                    try:
+                        for job in futures.as_completed(jobs):
+                            job.result()
+                    except exception.ImageDownloadFailed:
+                        # NOTE: stop the other segments before the
+                        # executor waits for them.
+                        abort.set()
+                        raise
+            except exception.ImageDownloadFailed as e:
+                LOG.error("Cannot download image '%s': %s",
+                          self.identifier, e)
+                if written.get(0):
+                    f.truncate(written[0])
+                    os.replace(segmented, partial)
+                else:
+                    utils.rm(segmented)
+                raise
+
+        os.replace(segmented, partial)
+        return utils.get_file_checksum(partial,
+                                       block_size=CONF.io_block_size)
+
+    def _write_blocks(self, blocks, partial, offset, sha512, host=None):
+        """Write blocks of data into the partial file, starting at offset.
+
+        Disk space for the whole image is preallocated, without extending
+        the file, and the download is aborted as soon as we get more data
+        than the size that is advertised in the image list.
+
+        :param host: if set, the bandwidth used is accounted to this host.
+        """
+        size = int(self.size)
+        limiter = bandwidth.get_limiter()
+        pos = offset
+        with open(partial, "r+b" if offset else "wb") as f:
+            try:
+                utils.preallocate(f.fileno(), size)
+                f.seek(offset)
+                for block in blocks:
+                    if pos + len(block) > size:
+                        pos = None
+                        raise exception.ImageDownloadFailed(
+                            code=None,
+                            reason="image is larger than its advertised size")
+                    if host is not None:
+                        limiter.throttle(host, len(block))
                     f.write(block)
-                    f.flush()
+                    sha512.update(block)
+                    pos += len(block)
+            except (requests.exceptions.RequestException,
+                    urllib3.exceptions.HTTPError, OSError) as e:
+                LOG.error("Cannot download image '%s': %s",
+                          self.identifier, e)
+                raise exception.ImageDownloadFailed(code=None, reason=e)
+            finally:
+                # NOTE: release the preallocated space that has not
+                # been used. If the server sent too much data, the file is
+                # useless.
+                if pos is None:
+                    utils.rm(partial)
+                else:
+                    f.truncate(pos)
+
+    def _hash_partial(self, partial):
+        """Get the checksum and size of a partial download (if any)."""
+        # NOTE: calculate the checksum while we download the image, so
+        # that we do not need to read it again from disk. If we are resuming
+        # a download, we need to feed the existing data first.
+        sha512 = hashlib.sha512()
+        offset = 0
+        if os.path.exists(partial):
+            with open(partial, "rb") as f:
+                for block in utils.read_blocks(f, CONF.io_block_size):
+                    sha512.update(block)
+                offset = f.tell()
+        return sha512, offset
+
+    def _copy_file(self, url, location, partial):
+        """Copy the image from a local file:// mirror.
+
+        :returns: the SHA-512 digest of the copied image.
+        """
+        path = urllib.request.url2pathname(urllib.parse.urlparse(url).path)
         try:
-            self.verify_checksum(location=location)
-        except exception.ImageVerificationFailed as e:
-            LOG.error(e)
-            raise
+            size = os.path.getsize(path)
+        except OSError as e:
+            raise exception.ImageDownloadFailed(code=e.errno, reason=e)
+        if size != int(self.size):
+            raise exception.ImageDownloadFailed(
+                code=None,
+                reason="image size in mirror does not match its size")
+
+        sha512, offset = self._hash_partial(partial)
+        if offset > size:
+            utils.rm(partial)
+            sha512, offset = self._hash_partial(partial)
+
+        LOG.info("Copying image '%s' from '%s' into '%s'",
+                 self.identifier, url, location)
+        with open(path, "rb") as f:
+            f.seek(offset)
+            self._write_blocks(utils.read_blocks(f, CONF.io_block_size),
+                               partial, offset, sha512)
+        return sha512
+
+    def _download_stream(self, url, location, partial):
+        """Download the image using a single connection.
+
+        If there is a partial file from an interrupted download, the download
+        is resumed if the server supports range requests.
+
+        :returns: the SHA-512 digest of the downloaded image.
+        """
+        sha512, offset = self._hash_partial(partial)
+        headers = {}
+        if offset:
+            LOG.info("Resuming download of image '%s' from '%s' into '%s' "
+                     "at byte %d", self.identifier, url, location, offset)
+            headers["Range"] = "bytes=%d-" % offset
         else:
-            LOG.info("Image '%s' stored as '%s'",
-                     self.identifier, location)
+            LOG.info("Downloading image '%s' from '%s' into '%s'",
+                     self.identifier, url, location)
+
+        response = self._get(url, headers=headers)
+        if offset and response.status_code == 416:
+            response.close()
+            if offset != int(self.size):
+                LOG.warning("Cannot resume download of image '%s', "
+                            "downloading it again", self.identifier)
+                utils.rm(partial)
+                return self._download_stream(url, location, partial)
+        elif not response.ok:
+            LOG.error("Cannot download image: (%s) %s",
+                      response.status_code, response.reason)
+            raise exception.ImageDownloadFailed(code=response.status_code,
+                                                reason=response.reason)
+        elif offset and not self._resumes_at(response, offset):
+            LOG.warning("Server does not support resuming the download of "
+                        "image '%s', downloading it again", self.identifier)
+            response.close()
+            utils.rm(partial)
+            return self._download_stream(url, location, partial)
+        else:
+            length = response.headers.get("Content-Length")
+            if ("Content-Encoding" not in response.headers and
+                    length is not None and
+                    offset + int(length) > int(self.size)):
+                response.close()
+                utils.rm(partial)
+                raise exception.ImageDownloadFailed(
+                    code=response.status_code,
+                    reason="image is larger than its advertised size")
+
+            response.raw.decode_content = True
+            with response:
+                self._write_blocks(
+                    utils.read_blocks(response.raw, CONF.io_block_size),
+                    partial, offset, sha512,
+                    host=urllib.parse.urlparse(response.url).netloc)
+        return sha512
+
+    def _download_from(self, url, location, partial):
+        """Download the image from an URL into the partial file.
+
+        :returns: the SHA-512 digest of the downloaded image.
+        """
+        if url.startswith("file:"):
+            return self._copy_file(url, location, partial)
+
+        ranges_url = None
+        if not os.path.exists(partial):
+            ranges_url = self._get_ranges_url(url)
+
+        if ranges_url is not None:
+            return self._download_segmented(ranges_url, location, partial)
+        return self._download_stream(url, location, partial)
+
+    def _download(self, location):
+        """Download the image into location.
+
+        The image is downloaded into a partial file, that is only renamed
+        into location once its checksum is correct. Large images are
+        downloaded using several connections if the server allows it.
+
+        If the image has mirrors, the fastest healthy one is used first, and
+        if a download fails (or the checksum is not correct) the next mirror
+        is tried, resuming the download if possible.
+        """
+        partial = self.get_partial_location(os.path.dirname(location))
+        stats = mirrors.get_stats()
+
+        urls = stats.sort(self.mirrors + [self.uri])
+        for i, url in enumerate(urls):
+            start = time.monotonic()
+            try:
+                offset = os.path.getsize(partial)
+            except OSError:
+                offset = 0
+            try:
+                sha512 = self._download_from(url, location, partial)
+                self._check_checksum(sha512.hexdigest())
+            except (exception.ImageDownloadFailed,
+                    exception.ImageVerificationFailed) as e:
+                if isinstance(e, exception.ImageVerificationFailed):
+                    LOG.error(e)
+                    utils.rm(partial)
+                stats.record_failure(url)
+                if i == len(urls) - 1:
+                    raise
+                LOG.warning("Cannot download image '%s' from '%s', trying "
+                            "the next mirror", self.identifier, url)
+            else:
+                stats.record_success(url, int(self.size) - offset,
+                                     time.monotonic() - start)
+                break
+
+        os.replace(partial, location)
+        self.verified = True
+        self.save_fingerprint(location)
+        LOG.info("Image '%s' stored as '%s', checksum OK",
+                 self.identifier, location)
+
+    def get_partial_location(self, basedir):
+        """Get the file used while the image is being downloaded."""
+        return os.path.join(basedir, self.identifier + ".part")
+
+    def get_segments_location(self, basedir):
+        """Get the file used while the image is downloaded in segments."""
+        return os.path.join(basedir, self.identifier + ".segments")
 
     def download(self, basedir):
+        """Download the image into a directory, if it is not there already.
+
+        If the image has not been verified yet, the copy that is already in
+        the directory (if any) is verified first.
+
+        :param basedir: destination directory.
+        """
         # The image has been already downloaded in this execution.
         if self.location is not None:
             raise exception.ImageAlreadyDownloaded(location=self.location)
 
         location = os.path.join(basedir, self.identifier)
 
-        if not os.path.exists(location):
+        if not (self.verified or self.verify_cached(basedir)):
             self._download(location)
-        else:
-            # Image exists, is it checksum valid?
-            try:
-                self.verify_checksum(location=location)
-            except exception.ImageVerificationFailed:
-                LOG.warning("Image '%s' present in '%s' is not valid, "
-                            "downloading again",
-                            self.identifier, location)
-                self._download(location)
 
         self.location = location
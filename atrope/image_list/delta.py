@@ -0,0 +1,106 @@
+# -*- coding: utf-8 -*-
+
+# Copyright 2026 The atrope contributors
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import time
+
+from atrope import manifest
+
+
+def get_image_versions(images):
+    """Get the version of each image, keyed by its identifier.
+
+    Two images with the same identifier are considered to be the same version
+    if both their hv:version and their checksum match.
+    """
+    return {img.identifier: [img.version, img.sha512] for img in images}
+
+
+class ImageListDelta(object):
+    """The differences between two versions of an image list.
+
+    Each of the added, removed, changed and unchanged attributes is a set
+    containing the affected image identifiers.
+    """
+
+    def __init__(self, previous, current):
+        self.added = set(current) - set(previous)
+        self.removed = set(previous) - set(current)
+        common = set(current) & set(previous)
+        self.changed = set(i for i in common if previous[i] != current[i])
+        self.unchanged = common - self.changed
+
+    def __str__(self):
+        return ("<ImageListDelta added:%d, removed:%d, changed:%d, "
+                "unchanged:%d>" % (len(self.added), len(self.removed),
+                                   len(self.changed), len(self.unchanged)))
+
+
+class DeltaTracker(object):
+    """Track the images of a list that a consumer has already processed.
+
+    The versions of the images that were successfully processed are stored
+    in the state manifest, so that the next run can compute what has changed
+    since then.
+
+    :param list_name: name of the image list.
+    :param consumer: name of the consumer processing the images.
+    :param config: identifies the configuration of the consumer, if it
+                   changes all the images will be considered as new.
+    """
+
+    def __init__(self, list_name, consumer, config=None):
+        self.list_name = list_name
+        self.consumer = consumer
+        self.config = config
+
+    def _load_data(self):
+        processed = manifest.get_manifest().get_processed(self.list_name,
+                                                          self.consumer)
+        return {i: v for i, v in processed.items() if v[2] == self.config}
+
+    def _load(self):
+        return {i: [v[0], v[1]] for i, v in self._load_data().items()}
+
+    def get_timestamps(self):
+        """Get when each of the recorded images was last processed."""
+        return {i: v[3] for i, v in self._load_data().items()}
+
+    def diff(self, images):
+        """Compute the changes since the last commit.
+
+        :param images: the images in the current version of the list.
+        """
+        return ImageListDelta(self._load(), get_image_versions(images))
+
+    def commit(self, images):
+        """Record the images that have been successfully processed.
+
+        The time when each image was processed is also recorded, keeping the
+        previous time for the images that have not changed.
+        """
+        previous = self._load_data()
+        now = time.time()
+        processed = {}
+        for identifier, version in get_image_versions(images).items():
+            timestamp = now
+            if identifier in previous:
+                if [previous[identifier][0],
+                        previous[identifier][1]] == version:
+                    timestamp = previous[identifier][3]
+            processed[identifier] = (version[0], version[1], self.config,
+                                     timestamp)
+        manifest.get_manifest().set_processed(self.list_name, self.consumer,
+                                              processed)
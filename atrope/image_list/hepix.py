@@ -15,19 +15,24 @@
 # under the License.
 
 import datetime
+import hashlib
 import json
 import pprint
+import re
+import sys
+import threading
 
 import dateutil.parser
 import dateutil.tz
 from oslo_config import cfg
 from oslo_log import log
-import requests
 
 from atrope import endorser
 from atrope import exception
 from atrope import image
 from atrope.image_list import source
+from atrope import manifest
+from atrope import session
 from atrope import smime
 from atrope import utils
 
@@ -35,6 +40,12 @@ opts = [
     cfg.StrOpt('hepix_sources',
                default='/etc/atrope/hepix.yaml',
                help='Where the HEPiX image list sources are stored.'),
+    cfg.BoolOpt('streaming_parse',
+                default=True,
+                help='Parse the image lists incrementally, indexing the '
+                     'image definitions one at a time instead of building '
+                     'the whole JSON document in memory first. This reduces '
+                     'the memory needed for large image lists.'),
 ]
 
 CONF = cfg.CONF
@@ -42,6 +53,93 @@ CONF.register_opts(opts, group="sources")
 
 LOG = log.getLogger(__name__)
 
+_WHITESPACE = re.compile(r'[ \t\n\r]*')
+
+
+class _JSONStream(object):
+    """Incremental reader for a JSON document.
+
+    Objects and arrays are walked through generators, so that their members
+    can be decoded one at a time. Callers must consume each member (with
+    value(), members() or elements()) before asking for the next one.
+    """
+
+    def __init__(self, data):
+        self.data = data
+        self.idx = 0
+        # NOTE: the JSON scanner only reuses the keys within a single
+        # decode call, so intern them in order not to have a copy of every
+        # key for each of the images.
+        self._decoder = json.JSONDecoder(
+            object_pairs_hook=lambda pairs: {sys.intern(k): v
+                                             for k, v in pairs})
+
+    def _next_char(self):
+        self.idx = _WHITESPACE.match(self.data, self.idx).end()
+        char = self.data[self.idx:self.idx + 1]
+        self.idx += 1
+        return char
+
+    def _iterate(self, start, end):
+        if self._next_char() != start:
+            raise ValueError("Expecting '%s' at char %d" % (start, self.idx))
+        if self._next_char() == end:
+            return
+        self.idx -= 1
+        while True:
+            yield
+            char = self._next_char()
+            if char == end:
+                return
+            elif char != ",":
+                raise ValueError("Expecting ',' delimiter at char %d" %
+                                 self.idx)
+
+    def members(self):
+        """Iterate over the keys of an object."""
+        for _ in self._iterate("{", "}"):
+            if self._next_char() != '"':
+                raise ValueError("Expecting property name at char %d" %
+                                 self.idx)
+            key, self.idx = json.decoder.scanstring(self.data, self.idx)
+            if self._next_char() != ":":
+                raise ValueError("Expecting ':' delimiter at char %d" %
+                                 self.idx)
+            yield key
+
+    def elements(self):
+        """Iterate over the elements of an array."""
+        return self._iterate("[", "]")
+
+    def value(self):
+        """Decode the next value."""
+        self.idx = _WHITESPACE.match(self.data, self.idx).end()
+        value, self.idx = self._decoder.raw_decode(self.data, self.idx)
+        return value
+
+    def end(self):
+        if self._next_char():
+            raise ValueError("Extra data at char %d" % self.idx)
+
+
+def _iter_image_list(data):
+    """Iterate over the fields of a serialized HEPiX image list.
+
+    The "hv:images" field is returned as a generator over the image
+    definitions, that must be consumed before the next field is requested.
+    """
+    stream = _JSONStream(data)
+    for key in stream.members():
+        if key != "hv:imagelist":
+            stream.value()
+            continue
+        for key in stream.members():
+            if key == "hv:images":
+                yield key, (stream.value() for _ in stream.elements())
+            else:
+                yield key, stream.value()
+    stream.end()
+
 
 class HepixImageList(object):
     """A Hepix Image List.
@@ -62,10 +160,62 @@ class HepixImageList(object):
         "hv:uri",
     )
 
+    __slots__ = ("created", "expires", "uuid", "description", "name",
+                 "source", "version", "uri", "endorser", "vo", "_entries",
+                 "_images", "_lock")
+
     def __init__(self, meta):
-        meta = meta.get("hv:imagelist", {})
-        keys = meta.keys()
-        if not all([i in keys for i in self.required_fields]):
+        imagelist = None
+        if isinstance(meta, dict):
+            imagelist = meta.get("hv:imagelist", {})
+        if (not isinstance(imagelist, dict) or
+                not isinstance(imagelist.get("hv:images", []), list)):
+            reason = "Invalid image list, unexpected JSON structure"
+            raise exception.InvalidImageList(reason=reason)
+        self._load(imagelist.items())
+
+    @classmethod
+    def from_json(cls, data):
+        """Build an image list from its JSON serialization.
+
+        If CONF.sources.streaming_parse is set, the image definitions are
+        decoded and indexed one at a time.
+
+        :raises: exception.InvalidImageList if the data is not a valid
+                 serialized image list.
+        """
+        try:
+            if isinstance(data, bytes):
+                data = data.decode(json.detect_encoding(data))
+            if not CONF.sources.streaming_parse:
+                return cls(json.loads(data))
+
+            image_list = cls.__new__(cls)
+            image_list._load(_iter_image_list(data))
+            return image_list
+        except ValueError as e:
+            raise exception.InvalidImageList(reason="Invalid JSON (%s)." % e)
+
+    def _load(self, fields):
+        # NOTE: Image lists can be huge, and we are normally
+        # subscribed to just a few of its images. Therefore we only index the
+        # image definitions here, building the image objects on demand.
+        self._entries = {}
+        self._images = {}
+        self._lock = threading.Lock()
+
+        meta = {}
+        for key, value in fields:
+            if key == "hv:images":
+                for img_meta in value:
+                    image_dict = image.HepixImage.validate(img_meta)
+                    for field in image.HepixImage.interned_fields:
+                        if isinstance(image_dict[field], str):
+                            image_dict[field] = sys.intern(image_dict[field])
+                    self._entries[image_dict["dc:identifier"]] = image_dict
+            meta[key] = value
+
+        if not all([i in meta for i in self.required_fields]):
             reason = "Invalid image list, missing mandatory fields"
             raise exception.InvalidImageList(reason=reason)
 
@@ -81,14 +231,35 @@ class HepixImageList(object):
         endorser_meta = meta.get("hv:endorser")
         self.endorser = endorser.Endorser(endorser_meta)
 
-        self.images = []
-        for img_meta in meta.get("hv:images"):
-            self.images.append(image.HepixImage(img_meta))
-
         self.vo = meta.get('ad:vo', None)
 
-    def get_images(self):
-        return self.images
+    def get_identifiers(self):
+        """Get the identifiers of all the images in the list."""
+        return list(self._entries)
+
+    def get_image(self, identifier):
+        """Get an image from the list.
+
+        :raises: KeyError if the image is not in the list.
+        """
+        with self._lock:
+            img = self._images.get(identifier)
+            if img is None:
+                img = image.HepixImage({"hv:image": self._entries[identifier]})
+                self._images[identifier] = img
+                # NOTE: the image holds the definition from now on
+                self._entries[identifier] = None
+        return img
+
+    def get_images(self, identifiers=None):
+        """Get the images from the list.
+
+        :param identifiers: if set, only return the images with these
+                            identifiers that are present in the list.
+        """
+        if identifiers is None:
+            identifiers = self._entries
+        return [self.get_image(i) for i in identifiers if i in self._entries]
 
 
 class HepixImageListSource(source.BaseImageListSource):
@@ -107,6 +278,8 @@ class HepixImageListSource(source.BaseImageListSource):
         )
 
         self.token = kwargs.get("token", "")
+        self.priority = int(kwargs.get("priority", 0))
+        self.mirrors = kwargs.get("mirrors", {})
 
         self.endorser = kwargs.get("endorser", {})
 
@@ -133,18 +306,62 @@ class HepixImageListSource(source.BaseImageListSource):
     def fetch(self):
         if self.enabled and self.url:
             self.contents = self._fetch()
+
+            self._load(hashlib.sha256(self.contents).hexdigest(),
+                       smime.get_ca_fingerprint())
+            self.expired = self._check_expiry()
+
+    def _load(self, digest, ca_fingerprint):
+        """Verify, parse and check the trust of the fetched list contents.
+
+        The results are stored in the state manifest, keyed by the digest of
+        the list contents and the fingerprint of the CA directory, so that an
+        unchanged list does not need to be verified again, until the first
+        certificate of the signer chain expires.
+        """
+        row = manifest.get_manifest().get_list_verification(self.name) or {}
+        memo = row.get("verification") or {}
+        if (row.get("digest") == digest and
+                row.get("ca_fingerprint") == ca_fingerprint and
+                not smime.Signer(**memo["signer"]).is_expired()):
+            LOG.debug("List '%s' was already verified, using cached "
+                      "verification results", self.name)
+            self.verified = True
+            self.signer = smime.Signer(**memo["signer"])
+            raw_list = row["payload"]
+        else:
             self.verified, self.signer, raw_list = self._verify()
-            try:
-                list_as_dict = json.loads(raw_list)
-            except ValueError:
-                LOG.error("Invalid JSON for image list '%s'", self.name)
-                raise exception.InvalidImageList(reason="Invalid JSON.")
+            if isinstance(raw_list, str):
+                raw_list = raw_list.encode("utf-8")
+            memo = {}
 
-            image_list = HepixImageList(list_as_dict)
-            self.image_list = image_list
+        try:
+            self.image_list = HepixImageList.from_json(raw_list)
+        except exception.InvalidImageList as e:
+            LOG.error("Invalid image list '%s': %s", self.name, e)
+            raise
 
-            self.expired = self._check_expiry()
+        if memo and memo.get("endorser") == self.endorser:
+            self.trusted = memo["trusted"]
+            if not self.trusted:
+                self.error = memo["error"]
+                LOG.error(self.error)
+        else:
             self.trusted = self._check_endorser()
+            self._save_verified(digest, ca_fingerprint, raw_list)
+
+    def _save_verified(self, digest, ca_fingerprint, raw_list):
+        """Store the verification results for a list."""
+        memo = {
+            "signer": {"dn": self.signer.dn, "ca": self.signer.ca,
+                       "not_after": self.signer.not_after},
+            "endorser": self.endorser,
+            "trusted": self.trusted,
+            "error": None if self.trusted else str(self.error),
+        }
+        manifest.get_manifest().set_list_verification(self.name, digest,
+                                                      ca_fingerprint, memo,
+                                                      raw_list)
 
     def _fetch(self):
         """Get the image list from the server.
@@ -159,13 +376,51 @@ class HepixImageListSource(source.BaseImageListSource):
             auth = (self.token, 'x-oauth-basic')
         else:
             auth = None
-        response = requests.get(self.url, auth=auth)
-        if response.status_code != 200:
+
+        headers = {}
+        cached_meta, cached_contents = self._load_cached_response()
+        if cached_contents is not None:
+            if cached_meta.get("etag"):
+                headers["If-None-Match"] = cached_meta["etag"]
+            if cached_meta.get("last_modified"):
+                headers["If-Modified-Since"] = cached_meta["last_modified"]
+
+        response = session.get_session().get(self.url, auth=auth,
+                                             headers=headers)
+        if response.status_code == 304 and cached_contents is not None:
+            LOG.debug("List '%s' has not been modified, using cached copy",
+                      self.name)
+            return cached_contents
+        elif response.status_code != 200:
             raise exception.ImageListDownloadFailed(code=response.status_code,
                                                     reason=response.reason)
         else:
+            self._save_cached_response(response)
             return response.content
 
+    def _load_cached_response(self):
+        """Load the last downloaded copy of the list from the manifest.
+
+        :returns: tuple (meta, contents) with the response metadata and
+                  the cached list, contents will be None if there is no
+                  usable copy.
+        """
+        row = manifest.get_manifest().get_list_response(self.name)
+        if not row or row["url"] != self.url or row["body"] is None:
+            return {}, None
+        return row, row["body"]
+
+    def _save_cached_response(self, response):
+        """Store the list and its validators for conditional requests."""
+        etag = response.headers.get("ETag")
+        last_modified = response.headers.get("Last-Modified")
+        if not (etag or last_modified):
+            return
+
+        manifest.get_manifest().set_list_response(self.name, self.url, etag,
+                                                  last_modified,
+                                                  response.content)
+
     def _verify(self):
         """Verify the image list SMIME signature.
 
@@ -232,7 +487,7 @@ class HepixImageListSource(source.BaseImageListSource):
         if self.contents is not None and contents:
             d["contents"] = pprint.pformat(self.contents)
         try:
-            images = [str(img.identifier) for img in self.get_images()]
+            images = [str(i) for i in self.get_image_identifiers()]
         except exception.ImageListNotFetched:
             images = None
         if images:
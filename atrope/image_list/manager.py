@@ -15,6 +15,7 @@
 # under the License.
 
 import abc
+from concurrent import futures
 
 from oslo_config import cfg
 from oslo_log import log
@@ -26,7 +27,16 @@ import atrope.dispatcher.manager
 from atrope import exception
 import atrope.image_list.hepix
 
+opts = [
+    cfg.IntOpt('workers',
+               default=8,
+               min=1,
+               help='Maximum number of image lists that will be fetched and '
+                    'verified concurrently.'),
+]
+
 CONF = cfg.CONF
+CONF.register_opts(opts, group="sources")
 CONF.import_opt("hepix_sources", "atrope.image_list.hepix", group="sources")
 
 LOG = log.getLogger(__name__)
@@ -78,35 +88,57 @@ class BaseImageListManager(object):
         return self._fetch_and_verify(lst)
 
     def fetch_lists(self):
-        """Fetch (and verify) all the configured lists."""
-        all_lists = []
-        for lst in self.lists.values():
-            lst = self._fetch_and_verify(lst)
-            all_lists.append(lst)
+        """Fetch (and verify) all the configured lists.
+
+        Lists are fetched and verified concurrently, using at most
+        CONF.sources.workers threads.
+        """
+        with futures.ThreadPoolExecutor(
+                max_workers=CONF.sources.workers) as executor:
+            all_lists = list(executor.map(self._fetch_and_verify,
+                                          self.lists.values()))
 
         return all_lists
 
-    def cache(self):
-        """Fetch, verify and sync all configured lists."""
+    def cache(self, dry_run=False):
+        """Fetch, verify and sync all configured lists.
+
+        :param dry_run: do not download or remove any file from the cache,
+                        only report them.
+        """
         self.fetch_lists()
-        self.cache_manager.sync(self.lists)
+        self.cache_manager.sync(self.lists, dry_run=dry_run)
 
-    def cache_one(self, lst):
-        """Fetch, verify and sync one lists."""
+    def cache_one(self, lst, dry_run=False):
+        """Fetch, verify and sync one lists.
+
+        :returns: False if the list is locked by another process.
+        """
         self.fetch_list(lst)
-        self.cache_manager.sync_one(lst)
+        return self.cache_manager.sync_one(lst, dry_run=dry_run)
 
-    def sync(self):
-        """Sync all the cached images with the dispatchers."""
+    def sync(self, dry_run=False):
+        """Sync all the cached images with the dispatchers.
 
-        for lst in self.lists.values():
-            self.sync_one(lst)
+        :param dry_run: do not download, remove or dispatch any image, only
+                        report them.
+        """
 
-    def sync_one(self, lst):
+        self.fetch_lists()
+        for lst in sorted(self.lists.values(), key=lambda lst: -lst.priority):
+            # NOTE: the list is dispatched while it is still locked, and it
+            # is not dispatched at all if it is being processed by another
+            # process, as its images are unknown.
+            self.cache_manager.sync_one(
+                lst, dry_run=dry_run, dispatch=self.dispatcher_manager.sync)
+        self.cache_manager.evict(self.lists.values(), dry_run=dry_run)
+
+    def sync_one(self, lst, dry_run=False):
         """Sync one cached image list with the dispatchers."""
 
-        self.cache_one(lst)
-        self.dispatcher_manager.sync(lst)
+        self.fetch_list(lst)
+        self.cache_manager.sync_one(lst, dry_run=dry_run,
+                                    dispatch=self.dispatcher_manager.sync)
 
 
 class YamlImageListManager(BaseImageListManager):
@@ -63,8 +63,7 @@ class BaseImageListSource(object):
         if not self.subscribed_images:
             return self.image_list.get_images()
         else:
-            return [img for img in self.image_list.get_images()
-                    if img.identifier in self.subscribed_images]
+            return self.image_list.get_images(self.subscribed_images)
 
     def get_images(self):
         """Get the images defined in the fetched image list."""
@@ -76,5 +75,15 @@ class BaseImageListSource(object):
 
         return self.image_list.get_images()
 
+    def get_image_identifiers(self):
+        """Get the identifiers of the images in the fetched image list."""
+        if not self.enabled:
+            return []
+
+        if self.image_list is None:
+            raise exception.ImageListNotFetched(id=self.name)
+
+        return self.image_list.get_identifiers()
+
     def print_list(self):
         pass
@@ -0,0 +1,283 @@
+# -*- coding: utf-8 -*-
+
+# Copyright 2026 The atrope contributors
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import contextlib
+import json
+import os
+import sqlite3
+import threading
+import time
+
+from oslo_config import cfg
+from oslo_log import log
+
+from atrope import exception
+from atrope import paths
+from atrope import utils
+
+opts = [
+    cfg.StrOpt('manifest_path',
+               default=paths.state_path_def('manifest.sqlite'),
+               help='SQLite database where atrope records its state: the '
+                    'metadata of the fetched lists, the verified images and '
+                    'the images that have been dispatched.'),
+]
+
+CONF = cfg.CONF
+CONF.register_opts(opts)
+
+LOG = log.getLogger(__name__)
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS lists (
+    name TEXT PRIMARY KEY,
+    url TEXT,
+    etag TEXT,
+    last_modified TEXT,
+    body BLOB,
+    digest TEXT,
+    ca_fingerprint TEXT,
+    verification TEXT,
+    payload BLOB,
+    updated_at REAL
+);
+CREATE TABLE IF NOT EXISTS files (
+    path TEXT PRIMARY KEY,
+    sha512 TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    inode INTEGER NOT NULL,
+    verified_at REAL
+);
+CREATE TABLE IF NOT EXISTS processed (
+    list_name TEXT NOT NULL,
+    consumer TEXT NOT NULL,
+    identifier TEXT NOT NULL,
+    version TEXT,
+    sha512 TEXT,
+    config TEXT,
+    processed_at REAL,
+    PRIMARY KEY (list_name, consumer, identifier)
+);
+CREATE TABLE IF NOT EXISTS mirrors (
+    key TEXT PRIMARY KEY,
+    throughput REAL,
+    failures INTEGER NOT NULL DEFAULT 0,
+    failed_at REAL NOT NULL DEFAULT 0
+);
+CREATE TABLE IF NOT EXISTS pending (
+    list_name TEXT NOT NULL,
+    identifier TEXT NOT NULL,
+    queued_at REAL NOT NULL,
+    PRIMARY KEY (list_name, identifier)
+);
+"""
+_SCHEMA_VERSION = 1
+
+_MANIFEST = None
+_MANIFEST_LOCK = threading.Lock()
+
+
+class Manifest(object):
+    """Embedded SQLite database recording the state of atrope.
+
+    All the methods are thread safe, and each of the updates is done in its
+    own transaction, so that a crash never leaves the state half written.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.RLock()
+        utils.makedirs(os.path.dirname(os.path.abspath(path)))
+        try:
+            self.conn = sqlite3.connect(path, timeout=60,
+                                        check_same_thread=False)
+            self.conn.row_factory = sqlite3.Row
+            self.conn.execute("PRAGMA journal_mode=WAL")
+            self.conn.execute("PRAGMA synchronous=NORMAL")
+            version = self.conn.execute("PRAGMA user_version").fetchone()[0]
+            if version < _SCHEMA_VERSION:
+                self.conn.executescript(_SCHEMA)
+                with self.conn:
+                    self.conn.execute("PRAGMA user_version = %d" %
+                                      _SCHEMA_VERSION)
+        except sqlite3.Error as e:
+            raise exception.ManifestError(path=path, reason=e)
+
+    @contextlib.contextmanager
+    def _transaction(self):
+        try:
+            with self.lock, self.conn:
+                yield self.conn
+        except sqlite3.Error as e:
+            raise exception.ManifestError(path=self.path, reason=e)
+
+    def _query(self, sql, *args):
+        with self._transaction() as conn:
+            return conn.execute(sql, args).fetchall()
+
+    # Image lists
+
+    def get_list_response(self, name):
+        """Get the last stored response of a list server, or None.
+
+        :returns: a dictionary with the url, etag, last_modified and body of
+                  the response.
+        """
+        rows = self._query("SELECT url, etag, last_modified, body FROM lists "
+                           "WHERE name = ?", name)
+        return dict(rows[0]) if rows else None
+
+    def get_list_verification(self, name):
+        """Get the stored verification results of a list, or None.
+
+        :returns: a dictionary with the digest, ca_fingerprint, verification
+                  and payload of the verified list.
+        """
+        rows = self._query("SELECT digest, ca_fingerprint, verification, "
+                           "payload FROM lists WHERE name = ?", name)
+        if not rows or rows[0]["verification"] is None:
+            return None
+        row = dict(rows[0])
+        row["verification"] = json.loads(row["verification"])
+        return row
+
+    def _upsert_list(self, conn, name, **values):
+        conn.execute("INSERT OR IGNORE INTO lists (name) VALUES (?)", (name,))
+        values["updated_at"] = time.time()
+        conn.execute("UPDATE lists SET %s WHERE name = ?" %
+                     ", ".join("%s = ?" % k for k in values),
+                     list(values.values()) + [name])
+
+    def set_list_response(self, name, url, etag, last_modified, body):
+        """Store the last response of a list server."""
+        with self._transaction() as conn:
+            self._upsert_list(conn, name, url=url, etag=etag,
+                              last_modified=last_modified, body=body)
+
+    def set_list_verification(self, name, digest, ca_fingerprint,
+                              verification, payload):
+        """Store the verification results of a list and its payload."""
+        with self._transaction() as conn:
+            self._upsert_list(conn, name, digest=digest,
+                              ca_fingerprint=ca_fingerprint,
+                              verification=json.dumps(verification),
+                              payload=payload)
+
+    # Verified files
+
+    def get_file(self, path):
+        """Get the stored fingerprint of a verified file, or None."""
+        rows = self._query("SELECT * FROM files WHERE path = ?",
+                           os.path.abspath(path))
+        return dict(rows[0]) if rows else None
+
+    def set_file(self, path, sha512, size, mtime_ns, inode):
+        """Record that a file has been verified."""
+        with self._transaction() as conn:
+            conn.execute("INSERT OR REPLACE INTO files VALUES "
+                         "(?, ?, ?, ?, ?, ?)",
+                         (os.path.abspath(path), sha512, size, mtime_ns, inode,
+                          time.time()))
+
+    def delete_file(self, path):
+        with self._transaction() as conn:
+            conn.execute("DELETE FROM files WHERE path = ?",
+                         (os.path.abspath(path),))
+
+    def prune_files(self):
+        """Forget the files that do not exist anymore."""
+        paths = [r["path"] for r in self._query("SELECT path FROM files")]
+        missing = [(p,) for p in paths if not os.path.exists(p)]
+        if missing:
+            with self._transaction() as conn:
+                conn.executemany("DELETE FROM files WHERE path = ?", missing)
+
+    # Images processed by a consumer (i.e. a dispatcher)
+
+    def get_processed(self, list_name, consumer):
+        """Get the images of a list that a consumer has processed.
+
+        :returns: a dictionary mapping image identifiers to tuples
+                  (version, sha512, config, processed_at).
+        """
+        rows = self._query("SELECT * FROM processed "
+                           "WHERE list_name = ? AND consumer = ?",
+                           list_name, consumer)
+        return {r["identifier"]: (r["version"], r["sha512"], r["config"],
+                                  r["processed_at"])
+                for r in rows}
+
+    def set_processed(self, list_name, consumer, processed):
+        """Replace the images of a list that a consumer has processed.
+
+        :param processed: a dictionary mapping image identifiers to tuples
+                          (version, sha512, config, processed_at).
+        """
+        with self._transaction() as conn:
+            conn.execute("DELETE FROM processed "
+                         "WHERE list_name = ? AND consumer = ?",
+                         (list_name, consumer))
+            conn.executemany("INSERT INTO processed VALUES "
+                             "(?, ?, ?, ?, ?, ?, ?)",
+                             [(list_name, consumer, i) + tuple(v)
+                              for i, v in processed.items()])
+
+    # Images waiting to be downloaded
+
+    def set_pending(self, list_name, identifiers):
+        """Replace the images of a list that are waiting to be downloaded.
+
+        Images that were already pending keep the time when they were first
+        queued, so that it is preserved across runs.
+
+        :returns: a dictionary mapping image identifiers to the time when
+                  they were first queued.
+        """
+        now = time.time()
+        with self._transaction() as conn:
+            rows = conn.execute("SELECT identifier, queued_at FROM pending "
+                                "WHERE list_name = ?", (list_name,))
+            queued = {r["identifier"]: r["queued_at"] for r in rows}
+            queued = {i: queued.get(i, now) for i in identifiers}
+            conn.execute("DELETE FROM pending WHERE list_name = ?",
+                         (list_name,))
+            conn.executemany("INSERT INTO pending VALUES (?, ?, ?)",
+                             [(list_name, i, t) for i, t in queued.items()])
+        return queued
+
+    # Mirrors
+
+    def get_mirrors(self):
+        return {r["key"]: {"throughput": r["throughput"],
+                           "failures": r["failures"],
+                           "failed_at": r["failed_at"]}
+                for r in self._query("SELECT * FROM mirrors")}
+
+    def set_mirror(self, key, throughput, failures, failed_at):
+        with self._transaction() as conn:
+            conn.execute("INSERT OR REPLACE INTO mirrors VALUES (?, ?, ?, ?)",
+                         (key, throughput, failures, failed_at))
+
+
+def get_manifest():
+    """Get the process wide state manifest."""
+    global _MANIFEST
+
+    with _MANIFEST_LOCK:
+        if _MANIFEST is None:
+            _MANIFEST = Manifest(CONF.manifest_path)
+    return _MANIFEST
@@ -0,0 +1,179 @@
+# -*- coding: utf-8 -*-
+
+# Copyright 2026 The atrope contributors
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import threading
+import time
+import urllib.parse
+
+from oslo_config import cfg
+from oslo_log import log
+
+from atrope import manifest
+
+opts = [
+    cfg.MultiStrOpt('mirror',
+                    default=[],
+                    help='Mirror rewrite rule, as PREFIX=MIRROR. Images '
+                         'whose URL starts with PREFIX can also be '
+                         'downloaded from the URL obtained replacing PREFIX '
+                         'with MIRROR, that can also be a local file:// URL. '
+                         'Can be specified multiple times. Rules for a '
+                         'single list can be set with the "mirrors" key in '
+                         'the list definition.'),
+    cfg.IntOpt('mirror_error_cooldown',
+               default=300,
+               min=0,
+               help='Number of seconds that a mirror is not used after a '
+                    'failed download, if there are other mirrors. It is '
+                    'doubled for each consecutive failure.'),
+]
+
+CONF = cfg.CONF
+CONF.register_opts(opts, group="http")
+
+LOG = log.getLogger(__name__)
+
+# Weight of the last measurement in the throughput of a mirror
+_ALPHA = 0.3
+# Downloads smaller than this are dominated by latency, ignore them
+_MIN_SAMPLE = 1024 * 1024
+_MAX_COOLDOWN = 24 * 3600
+
+_STATS = None
+_STATS_LOCK = threading.Lock()
+
+
+def _parse_rules(rules):
+    if isinstance(rules, dict):
+        for prefix, mirrors in rules.items():
+            if isinstance(mirrors, str):
+                mirrors = [mirrors]
+            for mirror in mirrors:
+                yield prefix, mirror
+    else:
+        for rule in rules:
+            prefix, sep, mirror = rule.partition("=")
+            if sep:
+                yield prefix.strip(), mirror.strip()
+            else:
+                LOG.warning(f"Ignoring invalid mirror rule '{rule}'")
+
+
+def get_mirror_urls(uri, rules=None):
+    """Get the mirror URLs of a given URL.
+
+    :param uri: the original URL.
+    :param rules: a dictionary mapping URL prefixes to one or several
+                  mirror prefixes, that will be used besides the rules in
+                  CONF.http.mirror.
+    :returns: a list of mirror URLs, not including the original one.
+    """
+    matches = []
+    for prefix, mirror in list(_parse_rules(rules or {})) + list(
+            _parse_rules(CONF.http.mirror)):
+        if prefix and uri.startswith(prefix):
+            matches.append((len(prefix), mirror + uri[len(prefix):]))
+
+    urls = []
+    # NOTE: sort is stable, so rules with the same prefix are kept
+    # in the order they were defined.
+    for _, url in sorted(matches, key=lambda m: -m[0]):
+        if url not in urls and url != uri:
+            urls.append(url)
+    return urls
+
+
+def _get_key(url):
+    parsed = urllib.parse.urlparse(url)
+    return f"{parsed.scheme}://{parsed.netloc}"
+
+
+class MirrorStats(object):
+    """Rolling throughput and error score of each mirror.
+
+    Mirrors are identified by their scheme and host, and the statistics are
+    kept in the state manifest across executions.
+    """
+
+    def __init__(self, manifest):
+        self.manifest = manifest
+        self.lock = threading.Lock()
+        self.stats = manifest.get_mirrors()
+
+    def _get(self, url):
+        return self.stats.setdefault(_get_key(url), {
+            "throughput": None,
+            "failures": 0,
+            "failed_at": 0,
+        })
+
+    def _save(self, url):
+        key = _get_key(url)
+        self.manifest.set_mirror(key, **self.stats[key])
+
+    def _is_healthy(self, stats, now):
+        if not stats["failures"]:
+            return True
+        cooldown = min(CONF.http.mirror_error_cooldown *
+                       2 ** (stats["failures"] - 1), _MAX_COOLDOWN)
+        return now - stats["failed_at"] >= cooldown
+
+    def sort(self, urls):
+        """Sort URLs, the fastest healthy mirror first.
+
+        Mirrors without measurements are tried before the ones that have
+        been measured, in order to get their throughput. Unhealthy mirrors
+        are kept at the end, as the last resort.
+        """
+        now = time.time()
+        with self.lock:
+            def key(url):
+                stats = self._get(url)
+                throughput = stats["throughput"]
+                if throughput is None:
+                    throughput = float("inf")
+                return (not self._is_healthy(stats, now), -throughput)
+            return sorted(urls, key=key)
+
+    def record_success(self, url, size, elapsed):
+        with self.lock:
+            stats = self._get(url)
+            stats["failures"] = 0
+            if size >= _MIN_SAMPLE and elapsed > 0:
+                throughput = size / elapsed
+                if stats["throughput"] is None:
+                    stats["throughput"] = throughput
+                else:
+                    stats["throughput"] = (_ALPHA * throughput +
+                                           (1 - _ALPHA) * stats["throughput"])
+            self._save(url)
+
+    def record_failure(self, url):
+        with self.lock:
+            stats = self._get(url)
+            stats["failures"] += 1
+            stats["failed_at"] = time.time()
+            self._save(url)
+
+
+def get_stats():
+    """Get the process wide mirror statistics."""
+    global _STATS
+
+    with _STATS_LOCK:
+        if _STATS is None:
+            _STATS = MirrorStats(manifest.get_manifest())
+    return _STATS
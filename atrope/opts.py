@@ -16,23 +16,32 @@
 
 import itertools
 
+import atrope.bandwidth
 import atrope.cache
 import atrope.dispatcher.glance
 import atrope.dispatcher.manager
 import atrope.image_list.hepix
 import atrope.image_list.manager
+import atrope.manifest
+import atrope.mirrors
 import atrope.paths
+import atrope.session
 import atrope.smime
 
 
 def list_opts():
     return [
         ('DEFAULT', itertools.chain(atrope.image.opts,
+                                    atrope.manifest.opts,
                                     atrope.paths.opts,
                                     atrope.smime.opts)
          ),
         ('cache', atrope.cache.opts),
-        ('sources', atrope.image_list.hepix.opts),
+        ('sources', itertools.chain(atrope.image_list.hepix.opts,
+                                    atrope.image_list.manager.opts)),
         ('dispatcher', atrope.dispatcher.manager.opts),
         ('glance', atrope.dispatcher.glance.opts),
+        ('http', itertools.chain(atrope.session.opts,
+                                 atrope.bandwidth.opts,
+                                 atrope.mirrors.opts)),
     ]
@@ -0,0 +1,84 @@
+# -*- coding: utf-8 -*-
+
+# Copyright 2026 The atrope contributors
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import threading
+
+from oslo_config import cfg
+import requests
+import requests.adapters
+from urllib3.util import retry
+
+opts = [
+    cfg.IntOpt('pool_connections',
+               default=10,
+               min=1,
+               help='Number of per-host connection pools that will be kept '
+                    'open, so that connections to the same host are reused '
+                    'across list and image downloads.'),
+    cfg.IntOpt('pool_maxsize',
+               default=10,
+               min=1,
+               help='Maximum number of connections that will be kept open '
+                    'for each host. It should not be lower than the number '
+                    'of concurrent downloads.'),
+    cfg.IntOpt('retries',
+               default=3,
+               min=0,
+               help='Number of times that a failed connection, or a request '
+                    'that failed with a server error, will be retried.'),
+    cfg.FloatOpt('retry_backoff',
+                 default=0.5,
+                 min=0,
+                 help='Backoff factor (in seconds) to apply between '
+                      'retries.'),
+]
+
+CONF = cfg.CONF
+CONF.register_opts(opts, group="http")
+
+_SESSION = None
+_SESSION_LOCK = threading.Lock()
+
+
+def _build_session():
+    retries = retry.Retry(total=CONF.http.retries,
+                          backoff_factor=CONF.http.retry_backoff,
+                          status_forcelist=(500, 502, 503, 504),
+                          raise_on_status=False)
+    adapter = requests.adapters.HTTPAdapter(
+        pool_connections=CONF.http.pool_connections,
+        pool_maxsize=CONF.http.pool_maxsize,
+        max_retries=retries,
+        pool_block=False)
+
+    session = requests.Session()
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+def get_session():
+    """Get the process wide HTTP session.
+
+    All the HTTP requests should be done through this session, so that
+    connections are kept alive and reused for the same host.
+    """
+    global _SESSION
+
+    with _SESSION_LOCK:
+        if _SESSION is None:
+            _SESSION = _build_session()
+    return _SESSION
@@ -14,11 +14,26 @@
 # License for the specific language governing permissions and limitations
 # under the License.
 
+import base64
+import email.parser
+import hashlib
+import os
+import re
 import subprocess
 import tempfile
+import threading
+import time
 
+from cryptography import exceptions as crypto_exc
+from cryptography.hazmat.primitives.asymmetric import ec
+from cryptography.hazmat.primitives.asymmetric import padding
+from cryptography.hazmat.primitives.asymmetric import rsa
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives import serialization
+from cryptography import x509
 import OpenSSL
 from oslo_config import cfg
+from oslo_log import log
 
 from atrope import exception
 
@@ -26,34 +41,512 @@ opts = [
     cfg.StrOpt('ca_path',
                default='/etc/grid-security/certificates/',
                help='Where to find CA certificates to verify against.'),
+    cfg.StrOpt('smime_backend',
+               default='native',
+               choices=['native', 'openssl'],
+               help='How to verify the S/MIME signature of the image lists. '
+                    'The "native" backend verifies the messages in-process, '
+                    'falling back to the "openssl" backend (that executes '
+                    'the openssl command) for messages that it does not '
+                    'support.'),
 ]
 
 CONF = cfg.CONF
 CONF.register_opts(opts)
 
+LOG = log.getLogger(__name__)
+
+OID_DATA = "1.2.840.113549.1.7.1"
+OID_SIGNED_DATA = "1.2.840.113549.1.7.2"
+OID_CONTENT_TYPE = "1.2.840.113549.1.9.3"
+OID_MESSAGE_DIGEST = "1.2.840.113549.1.9.4"
+OID_NETSCAPE_CERT_TYPE = "2.16.840.1.113730.1.1"
+
+# Netscape certificate type bits, as in OpenSSL
+NS_SSL_CLIENT = 0x80
+NS_SMIME = 0x20
+NS_SMIME_CA = 0x02
+
+DIGEST_ALGORITHMS = {
+    "1.2.840.113549.2.5": "md5",
+    "1.3.14.3.2.26": "sha1",
+    "2.16.840.1.101.3.4.2.4": "sha224",
+    "2.16.840.1.101.3.4.2.1": "sha256",
+    "2.16.840.1.101.3.4.2.2": "sha384",
+    "2.16.840.1.101.3.4.2.3": "sha512",
+}
+
+RSA_SIGNATURE_ALGORITHMS = (
+    "1.2.840.113549.1.1.1",   # rsaEncryption
+    "1.2.840.113549.1.1.4",   # md5WithRSAEncryption
+    "1.2.840.113549.1.1.5",   # sha1WithRSAEncryption
+    "1.2.840.113549.1.1.14",  # sha224WithRSAEncryption
+    "1.2.840.113549.1.1.11",  # sha256WithRSAEncryption
+    "1.2.840.113549.1.1.12",  # sha384WithRSAEncryption
+    "1.2.840.113549.1.1.13",  # sha512WithRSAEncryption
+)
+
+EC_SIGNATURE_ALGORITHMS = (
+    "1.2.840.10045.2.1",      # id-ecPublicKey
+    "1.2.840.10045.4.1",      # ecdsa-with-SHA1
+    "1.2.840.10045.4.3.1",    # ecdsa-with-SHA224
+    "1.2.840.10045.4.3.2",    # ecdsa-with-SHA256
+    "1.2.840.10045.4.3.3",    # ecdsa-with-SHA384
+    "1.2.840.10045.4.3.4",    # ecdsa-with-SHA512
+)
+
+_STORE = None
+_STORE_LOCK = threading.Lock()
+
+
+class UnsupportedMessage(Exception):
+    """The native backend does not know how to handle a message."""
+
+
+def get_ca_fingerprint():
+    """Get a fingerprint of the contents of CONF.ca_path.
+
+    The fingerprint will change whenever a CA certificate or a CRL is added,
+    removed or modified in the CA directory.
+    """
+    try:
+        entries = sorted(os.scandir(CONF.ca_path), key=lambda e: e.name)
+    except OSError:
+        entries = []
+
+    sha256 = hashlib.sha256(CONF.ca_path.encode("utf-8"))
+    for entry in entries:
+        try:
+            st = entry.stat()
+        except OSError:
+            continue
+        line = "%s %d %d\n" % (entry.name, st.st_size, st.st_mtime_ns)
+        sha256.update(line.encode("utf-8"))
+    return sha256.hexdigest()
+
+
+def get_ca_store():
+    """Get the process wide X509 store with the CAs from CONF.ca_path.
+
+    The store is only built again if the contents of the CA directory
+    change.
+    """
+    global _STORE
+
+    fingerprint = get_ca_fingerprint()
+    with _STORE_LOCK:
+        if _STORE is None or _STORE[0] != fingerprint:
+            store = OpenSSL.crypto.X509Store()
+            store.load_locations(None, CONF.ca_path)
+            _STORE = (fingerprint, store)
+    return _STORE[1]
+
+
+def _format_name(name):
+    aux = [(i.decode("utf-8"), j.decode("utf-8"))
+           for i, j in name.get_components()]
+    aux = "/".join(["=".join(i) for i in aux])
+    return f"/{aux}"
+
+
+class _DER(object):
+    """A BER/DER encoded ASN.1 element.
+
+    This is a minimal decoder, only intended to walk the PKCS#7 structures,
+    therefore it supports indefinite lengths (as produced by OpenSSL when
+    streaming) but not high tag numbers.
+    """
+
+    def __init__(self, data, offset=0):
+        self.data = data
+        self.start = offset
+        try:
+            self.tag = data[offset]
+            length = data[offset + 1]
+        except IndexError:
+            raise exception.SMIMEValidationError(err="truncated ASN.1 data")
+        if self.tag & 0x1f == 0x1f:
+            raise UnsupportedMessage("high tag numbers are not supported")
+
+        offset += 2
+        if length == 0x80:
+            self.content_start = offset
+            if not self.constructed:
+                raise exception.SMIMEValidationError(
+                    err="indefinite length in primitive ASN.1 element")
+            while data[offset:offset + 2] != b"\x00\x00":
+                offset = _DER(data, offset).end
+            self.content_end = offset
+            self.end = offset + 2
+        else:
+            if length & 0x80:
+                n = length & 0x7f
+                length = int.from_bytes(data[offset:offset + n], "big")
+                offset += n
+            self.content_start = offset
+            self.content_end = offset + length
+            self.end = self.content_end
+            if self.end > len(data):
+                raise exception.SMIMEValidationError(
+                    err="truncated ASN.1 data")
+
+    @property
+    def constructed(self):
+        return bool(self.tag & 0x20)
+
+    @property
+    def raw(self):
+        return self.data[self.start:self.end]
+
+    @property
+    def content(self):
+        return self.data[self.content_start:self.content_end]
+
+    def children(self):
+        offset = self.content_start
+        while offset < self.content_end:
+            child = _DER(self.data, offset)
+            yield child
+            offset = child.end
+
+    def octets(self):
+        """Get the value of an (optionally constructed) OCTET STRING."""
+        if not self.constructed:
+            return self.content
+        return b"".join(c.octets() for c in self.children())
+
+    def oid(self):
+        value = self.content
+        first = value[0]
+        arcs = [min(first // 40, 2), first - min(first // 40, 2) * 40]
+        n = 0
+        for byte in value[1:]:
+            n = (n << 7) | (byte & 0x7f)
+            if not byte & 0x80:
+                arcs.append(n)
+                n = 0
+        return ".".join(str(i) for i in arcs)
+
+    def integer(self):
+        return int.from_bytes(self.content, "big", signed=True)
+
 
 class Signer(object):
-    def __init__(self, dn, ca):
-        aux = [(i.decode("utf-8"), j.decode("utf-8"))
-               for i, j in dn.get_components()]
-        aux = "/".join(["=".join(i) for i in aux])
-        self.dn = f"/{aux}"
-        aux = [(i.decode("utf-8"), j.decode("utf-8"))
-               for i, j in ca.get_components()]
-        aux = "/".join(["=".join(i) for i in aux])
-        self.ca = f"/{aux}"
+    def __init__(self, dn, ca, not_after=None):
+        self.dn = dn
+        self.ca = ca
+        # NOTE: when the first certificate of the signer chain
+        # expires, as a POSIX timestamp.
+        self.not_after = not_after
+
+    def is_expired(self):
+        return self.not_after is None or time.time() >= self.not_after
 
     def __str__(self):
         return f"<Signer dn:{self.dn}, ca:{self.ca}>"
 
 
+class NativeVerifier(object):
+    """Verify S/MIME PKCS#7 signed messages in-process."""
+
+    def verify(self, data):
+        """Verify a signed message.
+
+        :returns: tuple (signer, content) with the signer certificate as PEM
+                  and the signed contents.
+        :raises: exception.SMIMEValidationError if the message cannot be
+                 verified.
+        :raises: UnsupportedMessage if the message format is not supported.
+        """
+        try:
+            content, der = self._parse_smime(data)
+            signed_data = self._get_signed_data(der)
+            content, content_type, certs, signer_infos = (
+                self._parse_signed_data(signed_data, content))
+
+            signers = []
+            for signer_info in signer_infos:
+                signers.append(self._verify_signer(signer_info, certs,
+                                                   content, content_type))
+        except (IndexError, StopIteration, ValueError) as e:
+            raise exception.SMIMEValidationError(
+                err="malformed PKCS#7 structure (%s)" % e)
+        if not signers:
+            raise exception.SMIMEValidationError(err="no signers found")
+
+        store = get_ca_store()
+        chain = [OpenSSL.crypto.X509.from_cryptography(c) for c in certs]
+        for cert in signers:
+            ctx = OpenSSL.crypto.X509StoreContext(
+                store,
+                OpenSSL.crypto.X509.from_cryptography(cert),
+                chain=chain)
+            try:
+                verified_chain = ctx.get_verified_chain()
+            except OpenSSL.crypto.X509StoreContextError as e:
+                raise exception.SMIMEValidationError(
+                    err="certificate verify error: %s" % e)
+            for i, aux in enumerate(verified_chain):
+                if not self._check_smime_sign_purpose(
+                        aux.to_cryptography(), ca=i > 0):
+                    raise exception.SMIMEValidationError(
+                        err="certificate verify error: unsuitable "
+                            "certificate purpose")
+
+        signer = b"".join(c.public_bytes(serialization.Encoding.PEM)
+                          for c in signers)
+        return signer, content
+
+    @staticmethod
+    def _get_netscape_cert_type(cert):
+        try:
+            ext = cert.extensions.get_extension_for_oid(
+                x509.ObjectIdentifier(OID_NETSCAPE_CERT_TYPE))
+        except x509.ExtensionNotFound:
+            return None
+        bits = _DER(ext.value.value).content
+        return bits[1] if len(bits) > 1 else 0
+
+    def _check_smime_sign_purpose(self, cert, ca=False):
+        """Check that a certificate can be used to sign S/MIME messages.
+
+        This is the same check that OpenSSL does for the "smimesign"
+        purpose, that "openssl smime -verify" uses by default.
+        """
+        try:
+            eku = cert.extensions.get_extension_for_class(
+                x509.ExtendedKeyUsage).value
+        except x509.ExtensionNotFound:
+            pass
+        else:
+            if x509.oid.ExtendedKeyUsageOID.EMAIL_PROTECTION not in eku:
+                return False
+
+        ns_cert_type = self._get_netscape_cert_type(cert)
+        if ca:
+            # NOTE: the CA checks (basic constraints, key usage) have
+            # already been done by OpenSSL when building the chain.
+            return ns_cert_type is None or bool(ns_cert_type & NS_SMIME_CA)
+
+        if ns_cert_type is not None and not (ns_cert_type &
+                                             (NS_SMIME | NS_SSL_CLIENT)):
+            return False
+
+        try:
+            ku = cert.extensions.get_extension_for_class(x509.KeyUsage).value
+        except x509.ExtensionNotFound:
+            return True
+        return ku.digital_signature or ku.content_commitment
+
+    @staticmethod
+    def _split_headers(data):
+        match = re.search(b"\r?\n\r?\n", data)
+        if not match:
+            raise UnsupportedMessage("cannot find MIME headers")
+        headers = email.parser.BytesHeaderParser().parsebytes(
+            data[:match.start()])
+        return headers, data[match.end():]
+
+    def _parse_smime(self, data):
+        """Split the S/MIME message into its content and signature.
+
+        :returns: tuple (content, der) with the detached content (or None
+                  if the content is embedded into the signature) and the
+                  DER encoded PKCS#7 structure.
+        """
+        headers, body = self._split_headers(data)
+        content_type = headers.get_content_type()
+
+        if content_type in ("application/pkcs7-mime",
+                            "application/x-pkcs7-mime"):
+            return None, base64.b64decode(body)
+        elif content_type != "multipart/signed":
+            raise UnsupportedMessage("unsupported content type %s" %
+                                     content_type)
+
+        boundary = headers.get_param("boundary")
+        if not boundary:
+            raise exception.SMIMEValidationError(err="no multipart boundary")
+        boundary = b"--" + boundary.encode("utf-8")
+
+        # NOTE: Mimic OpenSSL here, as the signed content is the first
+        # part with its line endings converted to CRLF, without the last one.
+        parts = []
+        lines = None
+        for line in body.split(b"\n"):
+            if line.startswith(boundary):
+                if lines is not None:
+                    parts.append(b"\r\n".join(lines))
+                if line[len(boundary):].startswith(b"--"):
+                    break
+                lines = []
+            elif lines is not None:
+                lines.append(line.rstrip(b"\r"))
+        else:
+            raise exception.SMIMEValidationError(
+                err="no closing multipart boundary")
+
+        if len(parts) != 2:
+            raise exception.SMIMEValidationError(
+                err="multipart/signed must have two parts")
+
+        headers, signature = self._split_headers(parts[1])
+        if headers.get_content_type() not in (
+                "application/pkcs7-signature",
+                "application/x-pkcs7-signature"):
+            raise exception.SMIMEValidationError(
+                err="invalid signature part content type")
+        return parts[0], base64.b64decode(signature)
+
+    @staticmethod
+    def _get_signed_data(der):
+        content_info = list(_DER(der).children())
+        if len(content_info) < 2 or content_info[0].oid() != OID_SIGNED_DATA:
+            raise UnsupportedMessage("not a PKCS#7 signedData structure")
+        # content [0] EXPLICIT SignedData
+        return next(content_info[1].children())
+
+    @staticmethod
+    def _parse_signed_data(signed_data, content):
+        # SignedData ::= SEQUENCE {
+        #     version, digestAlgorithms, contentInfo,
+        #     certificates [0] IMPLICIT OPTIONAL,
+        #     crls [1] IMPLICIT OPTIONAL,
+        #     signerInfos }
+        elements = list(signed_data.children())
+        encap = list(elements[2].children())
+        content_type = encap[0].oid()
+        if content is None:
+            if len(encap) < 2:
+                raise exception.SMIMEValidationError(
+                    err="no content in signed message")
+            content = next(encap[1].children()).octets()
+
+        certs = []
+        for element in elements[3:-1]:
+            if element.tag == 0xa0:
+                for cert in element.children():
+                    try:
+                        certs.append(x509.load_der_x509_certificate(
+                            cert.raw))
+                    except ValueError:
+                        raise exception.SMIMEValidationError(
+                            err="invalid certificate in signed message")
+
+        signer_infos = list(elements[-1].children())
+        return content, content_type, certs, signer_infos
+
+    @staticmethod
+    def _find_signer_cert(sid, certs):
+        if sid.tag == 0x80:
+            # subjectKeyIdentifier [0] IMPLICIT
+            for cert in certs:
+                try:
+                    ski = cert.extensions.get_extension_for_class(
+                        x509.SubjectKeyIdentifier)
+                except x509.ExtensionNotFound:
+                    continue
+                if ski.value.digest == sid.content:
+                    return cert
+        else:
+            issuer, serial = sid.children()
+            for cert in certs:
+                if (cert.serial_number == serial.integer() and
+                        cert.issuer.public_bytes() == issuer.raw):
+                    return cert
+        raise exception.SMIMEValidationError(
+            err="signer certificate not found")
+
+    def _verify_signer(self, signer_info, certs, content, content_type):
+        # SignerInfo ::= SEQUENCE {
+        #     version, sid, digestAlgorithm,
+        #     signedAttrs [0] IMPLICIT OPTIONAL,
+        #     signatureAlgorithm, signature,
+        #     unsignedAttrs [1] IMPLICIT OPTIONAL }
+        elements = list(signer_info.children())
+        cert = self._find_signer_cert(elements[1], certs)
+
+        digest_oid = next(elements[2].children()).oid()
+        digest_name = DIGEST_ALGORITHMS.get(digest_oid)
+        if digest_name is None:
+            raise UnsupportedMessage("unsupported digest %s" % digest_oid)
+        digest = hashlib.new(digest_name, content).digest()
+
+        if elements[3].tag == 0xa0:
+            signed_attrs, sig_alg, signature = elements[3:6]
+            message_digest = None
+            signed_content_type = None
+            for attr in signed_attrs.children():
+                attr_type, attr_values = attr.children()
+                if attr_type.oid() == OID_MESSAGE_DIGEST:
+                    message_digest = next(attr_values.children()).content
+                elif attr_type.oid() == OID_CONTENT_TYPE:
+                    signed_content_type = next(attr_values.children()).oid()
+            # NOTE: RFC 5652 requires the content type attribute to
+            # be signed, and to match the type of the encapsulated content.
+            if signed_content_type != content_type:
+                raise exception.SMIMEValidationError(
+                    err="content type attribute mismatch")
+            if message_digest != digest:
+                raise exception.SMIMEValidationError(err="digest failure")
+            # NOTE: the signature is calculated over the DER encoding
+            # of the attributes as a SET OF, not over the implicit tag.
+            signed = b"\x31" + signed_attrs.raw[1:]
+        else:
+            sig_alg, signature = elements[3:5]
+            signed = content
+
+        sig_oid = next(sig_alg.children()).oid()
+        hash_alg = getattr(hashes, digest_name.upper())()
+        key = cert.public_key()
+        try:
+            if (sig_oid in RSA_SIGNATURE_ALGORITHMS and
+                    isinstance(key, rsa.RSAPublicKey)):
+                key.verify(signature.content, signed,
+                           padding.PKCS1v15(), hash_alg)
+            elif (sig_oid in EC_SIGNATURE_ALGORITHMS and
+                    isinstance(key, ec.EllipticCurvePublicKey)):
+                key.verify(signature.content, signed,
+                           ec.ECDSA(hash_alg))
+            else:
+                raise UnsupportedMessage("unsupported signature algorithm "
+                                         "%s" % sig_oid)
+        except crypto_exc.InvalidSignature:
+            raise exception.SMIMEValidationError(
+                err="signature verification failure")
+        return cert
+
+
 class SMIMEVerifier(object):
     def verify(self, msg):
         signer, verified_data = self._get_signer_cert_and_verify(msg)
         if not signer:
             raise exception.SMIMEValidationError(err="no certificates found")
+        not_after = self._get_not_after(signer)
         issuer, signer = self._extract_signer_issuer_and_subject(signer)
-        return Signer(signer, issuer), verified_data
+        signer = Signer(_format_name(signer), _format_name(issuer),
+                        not_after=not_after)
+        return signer, verified_data
+
+    @staticmethod
+    def _get_not_after(signer):
+        """Get when the first certificate of the signer chains expires."""
+        if isinstance(signer, str):
+            signer = signer.encode("ascii")
+        certs = x509.load_pem_x509_certificates(signer)
+        not_after = min(c.not_valid_after_utc for c in certs)
+        chain = [OpenSSL.crypto.X509.from_cryptography(c) for c in certs]
+        for cert in chain:
+            ctx = OpenSSL.crypto.X509StoreContext(get_ca_store(), cert,
+                                                  chain=chain)
+            try:
+                verified_chain = ctx.get_verified_chain()
+            except OpenSSL.crypto.X509StoreContextError:
+                continue
+            not_after = min([not_after] +
+                            [c.to_cryptography().not_valid_after_utc
+                             for c in verified_chain])
+        return not_after.timestamp()
 
     def _extract_signer_issuer_and_subject(self, signer):
         x509 = OpenSSL.crypto.load_certificate(OpenSSL.crypto.FILETYPE_PEM,
@@ -61,6 +554,15 @@ class SMIMEVerifier(object):
         return x509.get_issuer(), x509.get_subject()
 
     def _get_signer_cert_and_verify(self, data):
+        if CONF.smime_backend == "native":
+            try:
+                return NativeVerifier().verify(data)
+            except UnsupportedMessage as e:
+                LOG.debug("Cannot verify message in-process (%s), falling "
+                          "back to openssl", e)
+        return self._openssl_verify(data)
+
+    def _openssl_verify(self, data):
         with tempfile.NamedTemporaryFile(mode="r", delete=True) as signer_file:
             process = subprocess.Popen(["openssl",
                                         "smime",
@@ -75,7 +577,9 @@ class SMIMEVerifier(object):
             if err is not None:
                 err = err.decode('utf-8')
 
-            if retcode == 2:
+            # NOTE: 2 means that the message cannot be read, 4 that
+            # the signature or the certificate cannot be verified.
+            if retcode in (2, 4):
                 raise exception.SMIMEValidationError(err=err)
             elif retcode:
                 # NOTE(dmllr): Python 2.6 compatibility:
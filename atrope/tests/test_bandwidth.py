@@ -0,0 +1,85 @@
+# -*- coding: utf-8 -*-
+
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import datetime
+from unittest import mock
+
+from atrope import bandwidth
+from atrope import exception
+from atrope.tests import base
+
+
+class TestTokenBucket(base.TestCase):
+
+    @mock.patch("time.sleep")
+    @mock.patch("time.monotonic", return_value=100)
+    def test_consume(self, m_monotonic, m_sleep):
+        bucket = bandwidth.TokenBucket(1000)
+        bucket.consume(1000)
+        m_sleep.assert_not_called()
+
+        # Going in debt waits until it has been paid
+        bucket.consume(500)
+        m_sleep.assert_called_once_with(0.5)
+
+        # The bucket is filled with time, and it never holds more than one
+        # second worth of tokens
+        m_sleep.reset_mock()
+        m_monotonic.return_value = 110
+        bucket.consume(1000)
+        m_sleep.assert_not_called()
+
+    @mock.patch("time.sleep")
+    def test_unlimited(self, m_sleep):
+        bucket = bandwidth.TokenBucket(0)
+        bucket.consume(10 ** 9)
+        m_sleep.assert_not_called()
+
+        bucket.consume(2000, rate=1000)
+        self.assertEqual(1, m_sleep.call_count)
+
+
+class TestBandwidthLimiter(base.TestCase):
+
+    def _at(self, hour, minute=0):
+        return datetime.datetime(2014, 1, 1, hour, minute)
+
+    def test_schedule(self):
+        limiter = bandwidth.BandwidthLimiter(
+            100, 0, {}, ["08:00-20:00=10", "22:30-06:00=0"])
+        self.assertEqual(10, limiter.get_rate(self._at(8)))
+        self.assertEqual(10, limiter.get_rate(self._at(19, 59)))
+        self.assertEqual(100, limiter.get_rate(self._at(20)))
+        self.assertEqual(100, limiter.get_rate(self._at(22, 29)))
+        self.assertEqual(0, limiter.get_rate(self._at(23)))
+        self.assertEqual(0, limiter.get_rate(self._at(5, 59)))
+        self.assertEqual(100, limiter.get_rate(self._at(6)))
+
+    def test_host_limits(self):
+        limiter = bandwidth.BandwidthLimiter(0, 100, {"a.example.org": "10"},
+                                             [])
+        self.assertEqual(10, limiter._get_host_bucket("a.example.org").rate)
+        self.assertEqual(100, limiter._get_host_bucket("b.example.org").rate)
+
+    def test_invalid_schedule(self):
+        for item in ("08:00-20:00", "8-20=10", "24:00-20:00=10",
+                     "08:60-20:00=10", "08:00-20:00=-1"):
+            self.assertRaises(exception.InvalidBandwidthSchedule,
+                              bandwidth.BandwidthLimiter, 0, 0, {}, [item])
+
+    def test_invalid_host_limit(self):
+        for value in ("fast", "-1", "1.5"):
+            self.assertRaises(exception.InvalidBandwidthLimit,
+                              bandwidth.BandwidthLimiter, 0, 0,
+                              {"a.example.org": value}, [])
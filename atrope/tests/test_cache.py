@@ -0,0 +1,362 @@
+# -*- coding: utf-8 -*-
+
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import hashlib
+import os
+import tempfile
+import time
+from unittest import mock
+
+import fixtures
+from oslo_config import cfg
+from oslo_config import fixture as config_fixture
+
+from atrope import cache
+from atrope import exception
+from atrope import image
+from atrope import manifest
+from atrope.tests import base
+from atrope.tests import test_hepix
+
+CONF = cfg.CONF
+
+
+class FakeImage(object):
+    def __init__(self, identifier, uri, mirrors=()):
+        self.identifier = identifier
+        self.sha512 = identifier * 64
+        self.uri = uri
+        self.mirrors = list(mirrors)
+
+    def get_partial_location(self, basedir):
+        return os.path.join(basedir, self.identifier + ".part")
+
+
+def _hepix_image(identifier, data):
+    meta = test_hepix._image(identifier)
+    meta["hv:image"]["hv:size"] = len(data)
+    meta["hv:image"]["sl:checksum:sha512"] = hashlib.sha512(data).hexdigest()
+    return image.HepixImage(meta)
+
+
+class TestCacheManager(base.TestCase):
+
+    def setUp(self):
+        super(TestCacheManager, self).setUp()
+        self.conf = self.useFixture(config_fixture.Config(CONF))
+        state_path = tempfile.mkdtemp()
+        self.conf.config(state_path=state_path)
+        self.conf.config(path=state_path + "/lists", group="cache")
+        self.useFixture(fixtures.MonkeyPatch("atrope.manifest._MANIFEST",
+                                             None))
+        self.useFixture(fixtures.MonkeyPatch("atrope.mirrors._STATS", None))
+        self.manager = cache.CacheManager()
+
+    def test_download_host_is_mirror(self):
+        img = FakeImage("a", "https://origin.example.org/a",
+                        mirrors=["https://mirror.example.org/a"])
+        dl = cache.ImageDownload(img, "imgdir", 0, 1)
+        self.assertEqual("mirror.example.org", dl.host)
+
+    def test_download_images_error_isolated(self):
+        images = [FakeImage(i, "https://example.org/%s" % i)
+                  for i in ("a", "b", "c")]
+        downloads = [cache.ImageDownload(img, "imgdir", 0, 1)
+                     for img in images]
+
+        def fetch(dl):
+            if dl.img.identifier == "b":
+                raise OSError("No space left on device")
+            return True
+
+        with mock.patch.object(self.manager, "_fetch_image",
+                               side_effect=fetch):
+            downloaded = self.manager._download_images(downloads)
+        self.assertEqual(["a", "c"],
+                         sorted(img.identifier for img in downloaded))
+
+    def test_pending_kept_across_runs(self):
+        mf = manifest.get_manifest()
+        with mock.patch("time.time", return_value=100):
+            queued = mf.set_pending("list", ["a", "b"])
+        self.assertEqual({"a": 100, "b": 100}, queued)
+        queued = mf.set_pending("list", ["b", "c"])
+        self.assertEqual(100, queued["b"])
+        self.assertGreater(queued["c"], 100)
+        self.assertEqual({}, mf.set_pending("other", []))
+        self.assertEqual(["b", "c"], sorted(mf.set_pending("list", queued)))
+
+    def test_plan_downloads_aged_first(self):
+        self.conf.config(download_max_wait=600, group="cache")
+        now = time.time()
+        small = cache.ImageDownload(FakeImage("a", "https://example.org/a"),
+                                    "imgdir", 0, 1, now)
+        large = cache.ImageDownload(FakeImage("b", "https://example.org/b"),
+                                    "imgdir", 0, 10, now - 3600)
+        admitted = self.manager._plan_downloads([small, large])
+        self.assertEqual([large, small], admitted)
+
+    def test_fetch_image_download_not_locked(self):
+        img = FakeImage("a", "https://example.org/a")
+        dl = cache.ImageDownload(img, "imgdir", 0, 1)
+
+        def download(imgdir):
+            with self.manager._lock_image(img.sha512, wait=False) as locked:
+                self.assertTrue(locked)
+
+        img.download = mock.Mock(side_effect=download)
+        with mock.patch.object(self.manager.blobs, "add") as add:
+            self.assertTrue(self.manager._fetch_image(dl))
+        img.download.assert_called_once_with("imgdir")
+        add.assert_called_once_with(img)
+
+    def test_download_lists_already_downloaded(self):
+        img = FakeImage("a", "https://example.org/a")
+        img.verified = True
+        img.location = "imgdir/a"
+        img.download = mock.Mock(
+            side_effect=exception.ImageAlreadyDownloaded(location="imgdir/a"))
+        lst = mock.Mock(priority=0)
+        lst.name = "list"
+        with mock.patch.object(self.manager, "_prepare_list",
+                               return_value=([img], "imgdir")):
+            self.manager._download_lists([lst])
+        img.download.assert_called_once_with("imgdir")
+
+    def _make_list(self, name):
+        lst = mock.Mock(priority=0)
+        lst.name = name
+        return lst
+
+    def test_sync_one_dispatch_locked(self):
+        lst = self._make_list("list")
+
+        def dispatch(lst):
+            with self.manager._lock("list-list", wait=False) as locked:
+                self.assertFalse(locked)
+
+        dispatch = mock.Mock(side_effect=dispatch)
+        with mock.patch.object(self.manager, "_download_lists"):
+            self.assertTrue(self.manager.sync_one(lst, dispatch=dispatch))
+        dispatch.assert_called_once_with(lst)
+
+    def test_sync_locks(self):
+        self.conf.config(lock_timeout=0, group="cache")
+        lists = {name: self._make_list(name) for name in ("a", "b", "c")}
+        for name in ("a", "b", "c", "old"):
+            os.makedirs(self.manager.path / name / "images")
+
+        def download(synced, dry_run=False):
+            self.assertEqual(["a", "c"], [lst.name for lst in synced])
+            # The cache is only locked in shared mode while downloading
+            with self.manager._lock("cache", shared=True,
+                                    wait=False) as locked:
+                self.assertTrue(locked)
+            self.manager._add_valid_path(self.manager.path / "a")
+
+        with self.manager._lock("list-b"):
+            with mock.patch.object(self.manager, "_download_lists",
+                                   side_effect=download) as m:
+                self.assertTrue(self.manager.sync(lists))
+        m.assert_called_once()
+        self.assertEqual(["a", "b"],
+                         sorted(p.name for p in self.manager.path.iterdir()
+                                if not p.name.startswith(".")))
+        self.assertTrue((self.manager.path / "b" / "images").exists())
+
+    def test_sync_one_dry_run(self):
+        lst = self._make_list("list")
+        img = FakeImage("a", "https://example.org/a")
+        img.verified = False
+        img.location = None
+        dispatch = mock.Mock()
+        with mock.patch.object(self.manager, "_prepare_list",
+                               return_value=([img], "imgdir")):
+            with mock.patch.object(self.manager, "_fetch_image") as fetch:
+                self.assertTrue(self.manager.sync_one(lst, dry_run=True,
+                                                      dispatch=dispatch))
+        fetch.assert_not_called()
+        dispatch.assert_not_called()
+        self.assertEqual({}, manifest.get_manifest().set_pending("list", []))
+
+    def _make_tree(self):
+        path = self.manager.path
+        for d in ("a/images", "b/images", "c/images/sub"):
+            os.makedirs(path / d)
+        for f in ("a/images/img", "a/images/old", "b/images/img",
+                  "c/images/sub/img"):
+            (path / f).write_bytes(b"x")
+        os.makedirs(self.manager.blobs.path / "ab")
+        (self.manager.blobs.path / "ab" / "blob").write_bytes(b"x")
+        for p in ("a", "a/images", "a/images/img"):
+            self.manager._add_valid_path(path / p)
+        return path
+
+    def test_find_invalid(self):
+        path = self._make_tree()
+        self.assertEqual(
+            sorted(os.fspath(path / p) for p in ("a/images/old", "b", "c")),
+            sorted(self.manager._find_invalid(path)))
+
+    def test_find_invalid_keep(self):
+        path = self._make_tree()
+        self.assertEqual(
+            sorted(os.fspath(path / p) for p in ("a/images/old", "c")),
+            sorted(self.manager._find_invalid(path, keep=[path / "b"])))
+
+    def test_clean_invalid(self):
+        path = self._make_tree()
+        self.manager._clean_invalid(path, dry_run=True)
+        self.assertTrue((path / "a" / "images" / "old").exists())
+        self.assertTrue((path / "c").exists())
+
+        self.manager._clean_invalid(path)
+        self.assertEqual(["img"], os.listdir(path / "a" / "images"))
+        self.assertEqual(sorted([".blobs", ".locks", "a"]),
+                         sorted(os.listdir(path)))
+        self.assertTrue((self.manager.blobs.path / "ab" / "blob").exists())
+
+    def _cached_list(self, name, sizes):
+        imgdir = self.manager.path / name / "images"
+        os.makedirs(imgdir)
+        images = []
+        for identifier, size in sizes.items():
+            img = FakeImage(identifier, "https://example.org/" + identifier)
+            img.size = size
+            img.location = os.fspath(imgdir / identifier)
+            with open(img.location, "wb") as f:
+                f.write(b"x" * size)
+            images.append(img)
+        lst = self._make_list(name)
+        lst.get_subscribed_images.return_value = images
+        return lst, images
+
+    def _evict(self, lists, dispatched, max_size, policy="lru"):
+        self.conf.config(max_size=max_size, eviction_policy=policy,
+                         group="cache")
+        with mock.patch("atrope.dispatcher.manager.get_dispatched",
+                        side_effect=lambda lst, images: dispatched[lst.name]):
+            self.manager._evict(lists)
+
+    def test_evict_lru(self):
+        lst, images = self._cached_list("l", {"a": 100, "b": 300, "c": 50})
+        self._evict([lst], {"l": {"a": 10, "b": 20}}, 400)
+        self.assertEqual([None, images[1].location, images[2].location],
+                         [img.location for img in images])
+        self.assertEqual(["b", "c"],
+                         sorted(os.listdir(self.manager.path / "l" /
+                                           "images")))
+
+    def test_evict_largest(self):
+        lst, images = self._cached_list("l", {"a": 100, "b": 300, "c": 50})
+        self._evict([lst], {"l": {"a": 10, "b": 20}}, 400, "largest")
+        self.assertEqual(["a", "c"],
+                         sorted(os.listdir(self.manager.path / "l" /
+                                           "images")))
+
+    def test_evict_not_dispatched_kept(self):
+        lst, images = self._cached_list("l", {"a": 100, "b": 300, "c": 50})
+        self._evict([lst], {"l": {"a": 10, "b": 20}}, 10)
+        self.assertEqual(["c"],
+                         os.listdir(self.manager.path / "l" / "images"))
+
+    def test_evict_shared_image(self):
+        lst1, images1 = self._cached_list("l1", {"a": 100})
+        lst2, images2 = self._cached_list("l2", {"a": 100})
+        self._evict([lst1, lst2], {"l1": {"a": 10}, "l2": {}}, 10)
+        self.assertIsNotNone(images1[0].location)
+        self.assertIsNotNone(images2[0].location)
+
+    def test_evict_under_max_size(self):
+        lst, images = self._cached_list("l", {"a": 100})
+        self._evict([lst], {"l": {"a": 10}}, 1000)
+        self.assertIsNotNone(images[0].location)
+
+
+class TestBlobStore(base.TestCase):
+
+    def setUp(self):
+        super(TestBlobStore, self).setUp()
+        self.conf = self.useFixture(config_fixture.Config(CONF))
+        state_path = tempfile.mkdtemp()
+        self.conf.config(ca_path=tempfile.mkdtemp(), state_path=state_path)
+        self.conf.config(path=state_path + "/lists", group="cache")
+        self.useFixture(fixtures.MonkeyPatch("atrope.manifest._MANIFEST",
+                                             None))
+        self.manager = cache.CacheManager()
+        self.blobs = self.manager.blobs
+        self.data = b"image data" * 100
+
+    def _downloaded_image(self, identifier, name):
+        img = _hepix_image(identifier, self.data)
+        imgdir = self.manager.path / name / "images"
+        os.makedirs(imgdir)
+        img.location = os.fspath(imgdir / identifier)
+        with open(img.location, "wb") as f:
+            f.write(self.data)
+        return img
+
+    def test_add_link(self):
+        img = self._downloaded_image("a", "list1")
+        self.blobs.add(img)
+        blob = self.blobs.get_location(img.sha512)
+        self.assertTrue(os.path.samefile(img.location, blob))
+        # Adding it again is a no-op
+        self.blobs.add(img)
+
+        other = _hepix_image("b", self.data)
+        imgdir = self.manager.path / "list2" / "images"
+        os.makedirs(imgdir)
+        self.assertTrue(self.blobs.link(other, imgdir))
+        self.assertTrue(other.verified)
+        self.assertTrue(os.path.samefile(imgdir / "b", blob))
+        self.assertEqual(3, blob.stat().st_nlink)
+
+    def test_link_not_stored(self):
+        img = _hepix_image("a", self.data)
+        self.assertFalse(self.blobs.link(img, self.manager.path))
+        self.assertFalse(img.verified)
+
+    def test_link_invalid_blob(self):
+        self.conf.config(paranoid=True)
+        img = _hepix_image("a", self.data)
+        blob = self.blobs.get_location(img.sha512)
+        os.makedirs(blob.parent)
+        blob.write_bytes(b"corrupted")
+        self.assertFalse(self.blobs.link(img, self.manager.path))
+        self.assertFalse(blob.exists())
+        self.assertFalse((self.manager.path / "a").exists())
+
+    def test_gc(self):
+        linked = self._downloaded_image("a", "list1")
+        self.blobs.add(linked)
+        self.data = b"other data"
+        unlinked = self._downloaded_image("b", "list2")
+        self.blobs.add(unlinked)
+        os.unlink(unlinked.location)
+
+        self.blobs.gc(dry_run=True)
+        self.assertTrue(self.blobs.get_location(unlinked.sha512).exists())
+
+        self.blobs.gc()
+        self.assertTrue(self.blobs.get_location(linked.sha512).exists())
+        self.assertFalse(self.blobs.get_location(unlinked.sha512).exists())
+
+    def test_gc_locked(self):
+        img = self._downloaded_image("a", "list1")
+        self.blobs.add(img)
+        os.unlink(img.location)
+        with self.manager._lock_image(img.sha512):
+            self.blobs.gc()
+        self.assertTrue(self.blobs.get_location(img.sha512).exists())
@@ -0,0 +1,138 @@
+# -*- coding: utf-8 -*-
+
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import collections
+import tempfile
+from unittest import mock
+
+import fixtures
+from oslo_config import cfg
+from oslo_config import fixture as config_fixture
+
+from atrope.dispatcher import manager
+from atrope.image_list import delta
+from atrope.tests import base
+
+CONF = cfg.CONF
+
+FakeImage = collections.namedtuple("FakeImage",
+                                   ["identifier", "version", "sha512"])
+
+
+class FakeDispatchImage(object):
+    def __init__(self, identifier, version):
+        self.identifier = identifier
+        self.version = version
+        self.sha512 = identifier * 128
+        self.title = "Image %s" % identifier
+
+
+class TestDeltaTracker(base.TestCase):
+
+    def setUp(self):
+        super(TestDeltaTracker, self).setUp()
+        self.conf = self.useFixture(config_fixture.Config(CONF))
+        self.conf.config(state_path=tempfile.mkdtemp())
+        self.useFixture(fixtures.MonkeyPatch("atrope.manifest._MANIFEST",
+                                             None))
+        self.images = [FakeImage("a", "1", "aa"), FakeImage("b", "1", "bb"),
+                       FakeImage("c", "1", "cc")]
+
+    def _tracker(self, consumer="glance", config="config"):
+        return delta.DeltaTracker("list", consumer, config)
+
+    def test_diff(self):
+        tracker = self._tracker()
+        d = tracker.diff(self.images)
+        self.assertEqual({"a", "b", "c"}, d.added)
+        self.assertEqual(set(), d.removed | d.changed | d.unchanged)
+
+        tracker.commit(self.images)
+        images = [FakeImage("a", "1", "aa"), FakeImage("b", "2", "bb"),
+                  FakeImage("c", "1", "cc2"), FakeImage("d", "1", "dd")]
+        d = self._tracker().diff(images)
+        self.assertEqual({"d"}, d.added)
+        self.assertEqual(set(), d.removed)
+        self.assertEqual({"b", "c"}, d.changed)
+        self.assertEqual({"a"}, d.unchanged)
+
+        d = self._tracker().diff(images[:1])
+        self.assertEqual({"b", "c"}, d.removed)
+
+    def test_consumers_and_config(self):
+        self._tracker().commit(self.images)
+        self.assertEqual({"a", "b", "c"},
+                         self._tracker(consumer="other").diff(
+                             self.images).added)
+        self.assertEqual({"a", "b", "c"},
+                         self._tracker(config="changed").diff(
+                             self.images).added)
+        self.assertEqual({"a", "b", "c"},
+                         self._tracker().diff(self.images).unchanged)
+
+    def test_timestamps(self):
+        tracker = self._tracker()
+        tracker.commit(self.images)
+        first = tracker.get_timestamps()
+        self.assertEqual({"a", "b", "c"}, set(first))
+
+        tracker.commit([FakeImage("a", "1", "aa"), FakeImage("b", "2", "bb")])
+        second = tracker.get_timestamps()
+        self.assertEqual({"a", "b"}, set(second))
+        self.assertEqual(first["a"], second["a"])
+        self.assertGreaterEqual(second["b"], first["b"])
+
+
+class TestDispatchDelta(base.TestCase):
+
+    def setUp(self):
+        super(TestDispatchDelta, self).setUp()
+        self.conf = self.useFixture(config_fixture.Config(CONF))
+        self.conf.config(state_path=tempfile.mkdtemp())
+        self.conf.config(dispatcher=["noop"], group="dispatchers")
+        self.useFixture(fixtures.MonkeyPatch("atrope.manifest._MANIFEST",
+                                             None))
+        self.image_list = mock.Mock(token="", prefix="", project="project")
+        self.image_list.name = "list"
+        self.image_list.image_list.vo = "vo"
+        self.manager = manager.DispatcherManager()
+        self.dispatch = self.useFixture(fixtures.MockPatchObject(
+            self.manager.dispatchers["noop"], "dispatch")).mock
+
+    def _sync(self, images):
+        self.dispatch.reset_mock()
+        self.image_list.get_valid_subscribed_images.return_value = images
+        self.manager.sync(self.image_list)
+        return sorted(c[0][1].identifier for c in self.dispatch.call_args_list)
+
+    def test_only_changes_dispatched(self):
+        images = [FakeDispatchImage("a", "1"), FakeDispatchImage("b", "1")]
+        self.assertEqual(["a", "b"], self._sync(images))
+        self.assertEqual([], self._sync(images))
+        self.assertEqual({"a": mock.ANY, "b": mock.ANY},
+                         manager.get_dispatched(self.image_list, images))
+
+        images[1] = FakeDispatchImage("b", "2")
+        self.assertEqual(["b"], self._sync(images))
+
+        self.image_list.prefix = "prefix-"
+        self.assertEqual(["a", "b"], self._sync(images))
+
+    def test_failed_dispatched_again(self):
+        images = [FakeDispatchImage("a", "1")]
+        self.dispatch.side_effect = Exception("failed")
+        self._sync(images)
+        self.dispatch.side_effect = None
+        self.assertEqual(["a"], self._sync(images))
+        self.assertEqual({}, manager.get_dispatched(self.image_list, []))
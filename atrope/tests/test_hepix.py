@@ -0,0 +1,171 @@
+# -*- coding: utf-8 -*-
+
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import json
+import tempfile
+import time
+
+import fixtures
+
+from oslo_config import cfg
+from oslo_config import fixture as config_fixture
+
+from atrope import exception
+from atrope.image_list import hepix
+from atrope import smime
+from atrope.tests import base
+
+CONF = cfg.CONF
+
+
+def _image(identifier):
+    return {"hv:image": {
+        "ad:group": "group",
+        "ad:mpuri": "https://example.org/mp/%s" % identifier,
+        "ad:user:fullname": "John Doe",
+        "ad:user:guid": "guid",
+        "ad:user:uri": "https://example.org/user",
+        "dc:description": "Image \"%s\" é" % identifier,
+        "dc:identifier": identifier,
+        "dc:title": "Title %s" % identifier,
+        "hv:hypervisor": "QEMU,KVM",
+        "hv:format": "qcow2",
+        "hv:size": 1024,
+        "hv:uri": "https://example.org/%s.qcow2" % identifier,
+        "hv:version": "1.0",
+        "sl:arch": "x86_64",
+        "sl:checksum:sha512": "0" * 128,
+        "sl:comments": "",
+        "sl:os": "Linux",
+        "sl:osname": "CentOS",
+        "sl:osversion": "7",
+    }}
+
+
+def _image_list(images):
+    return {
+        "hv:imagelist": {
+            "dc:date:created": "2014-01-01T00:00:00Z",
+            "dc:date:expires": "2499-01-01T00:00:00Z",
+            "dc:description": "A list",
+            "dc:identifier": "list-uuid",
+            "dc:source": "https://example.org",
+            "dc:title": "list",
+            "hv:endorser": {"hv:x509": {
+                "dc:creator": "Jane Doe",
+                "hv:ca": "/CN=TestCA",
+                "hv:dn": "/CN=signer",
+                "hv:email": "jane@example.org",
+            }},
+            "hv:images": images,
+            "hv:uri": "https://example.org/image.list",
+            "hv:version": "20140101",
+            "ad:vo": "vo.example.org",
+        },
+        "extra": {"ignored": [1, 2, {"a": None}]},
+    }
+
+
+def _dump(image_list):
+    fields = [getattr(image_list, attr)
+              for attr in ("created", "expires", "uuid", "description",
+                           "name", "source", "version", "uri", "vo")]
+    images = sorted((i.identifier, i.title, i.description, i.size)
+                    for i in image_list.get_images())
+    return fields + [str(image_list.endorser), images]
+
+
+class TestHepixImageList(base.TestCase):
+
+    def setUp(self):
+        super(TestHepixImageList, self).setUp()
+        self.conf = self.useFixture(config_fixture.Config(CONF))
+        self.conf.config(ca_path=tempfile.mkdtemp(),
+                         state_path=tempfile.mkdtemp())
+
+    def _from_json(self, data, streaming):
+        self.conf.config(streaming_parse=streaming, group="sources")
+        return hepix.HepixImageList.from_json(data)
+
+    def test_streaming_matches_json(self):
+        images = [_image("img-%d" % i) for i in range(5)]
+        for data in (json.dumps(_image_list(images)),
+                     json.dumps(_image_list(images), indent=4),
+                     json.dumps(_image_list([])),
+                     json.dumps(_image_list(images)).encode("utf-16")):
+            self.assertEqual(_dump(self._from_json(data, False)),
+                             _dump(self._from_json(data, True)))
+
+    def test_invalid(self):
+        valid = json.dumps(_image_list([_image("img")]))
+        for data in (
+                valid + " {}",
+                valid.replace('"hv:imagelist": ', '"hv:imagelist" '),
+                valid.replace('"list", "hv:endorser"',
+                              '"list" "hv:endorser"'),
+                valid[:-10],
+                "[]",
+                "",
+                json.dumps({"hv:imagelist": []}),
+                json.dumps(_image_list({"img": _image("img")})),
+                json.dumps(_image_list("img")),
+                json.dumps(_image_list(["img"])),
+                json.dumps(_image_list([{"hv:image": []}]))):
+            for streaming in (False, True):
+                self.assertRaises(exception.InvalidImageList,
+                                  self._from_json, data, streaming)
+
+    def test_missing_fields(self):
+        image_list = _image_list([_image("img")])
+        del image_list["hv:imagelist"]["dc:title"]
+        for streaming in (False, True):
+            self.assertRaises(exception.InvalidImageList,
+                              self._from_json, json.dumps(image_list),
+                              streaming)
+
+
+class TestHepixImageListSource(base.TestCase):
+
+    def setUp(self):
+        super(TestHepixImageListSource, self).setUp()
+        self.conf = self.useFixture(config_fixture.Config(CONF))
+        self.conf.config(ca_path=tempfile.mkdtemp(),
+                         state_path=tempfile.mkdtemp())
+        self.useFixture(fixtures.MonkeyPatch("atrope.manifest._MANIFEST",
+                                             None))
+        self.payload = json.dumps(_image_list([_image("img")]))
+        signer = smime.Signer("/CN=signer", "/CN=TestCA",
+                              not_after=time.time() + 3600)
+        self.verify = self.useFixture(fixtures.MockPatchObject(
+            hepix.HepixImageListSource, "_verify",
+            return_value=(True, signer, self.payload))).mock
+        self.useFixture(fixtures.MockPatchObject(
+            hepix.HepixImageListSource, "_fetch",
+            return_value=b"signed list"))
+
+    def test_fetch_unchanged(self):
+        lst = hepix.HepixImageListSource(
+            "list", url="https://example.org",
+            endorser={"dn": "/CN=signer", "ca": "/CN=TestCA"})
+        lst.fetch()
+        first = lst.get_subscribed_images()
+        first[0].location = "/some/where/img"
+        lst.fetch()
+        second = lst.get_subscribed_images()
+
+        self.assertTrue(lst.verified)
+        self.assertTrue(lst.trusted)
+        self.assertEqual(1, self.verify.call_count)
+        self.assertEqual(["img"], [i.identifier for i in second])
+        self.assertIsNone(second[0].location)
@@ -0,0 +1,232 @@
+# -*- coding: utf-8 -*-
+
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import hashlib
+import io
+import os
+import tempfile
+from unittest import mock
+
+import fixtures
+from oslo_config import cfg
+from oslo_config import fixture as config_fixture
+
+from atrope import exception
+from atrope import image
+from atrope import mirrors
+from atrope.tests import base
+from atrope.tests import test_hepix
+
+CONF = cfg.CONF
+
+DATA = b"0123456789abcdef" * 64
+
+
+class FakeResponse(object):
+    def __init__(self, data, status_code=200, headers=None):
+        self.raw = io.BytesIO(data)
+        self.status_code = status_code
+        self.headers = headers or {}
+        self.ok = status_code < 400
+        self.reason = "reason"
+        self.url = "https://example.org/img.qcow2"
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class TestHepixImage(base.TestCase):
+
+    def setUp(self):
+        super(TestHepixImage, self).setUp()
+        self.conf = self.useFixture(config_fixture.Config(CONF))
+        self.conf.config(ca_path=tempfile.mkdtemp(),
+                         state_path=tempfile.mkdtemp(),
+                         download_segments=4)
+        self.useFixture(fixtures.MonkeyPatch("atrope.manifest._MANIFEST",
+                                             None))
+        self.useFixture(fixtures.MonkeyPatch("atrope.mirrors._STATS", None))
+        self.useFixture(fixtures.MonkeyPatch("atrope.bandwidth._LIMITER",
+                                             None))
+        meta = test_hepix._image("img")
+        meta["hv:image"]["hv:size"] = len(DATA)
+        meta["hv:image"]["sl:checksum:sha512"] = hashlib.sha512(
+            DATA).hexdigest()
+        self.img = image.HepixImage(meta)
+        self.basedir = tempfile.mkdtemp()
+        self.location = os.path.join(self.basedir, "img")
+        self.partial = self.img.get_partial_location(self.basedir)
+
+    def test_download_segmented_failed_keeps_first_segment(self):
+        def segment(img, url, fd, start, end, abort, written):
+            if start:
+                raise exception.ImageDownloadFailed(code=None, reason="")
+            os.pwrite(fd, b"x" * 10, 0)
+            written[start] = 10
+
+        with mock.patch.object(image.HepixImage, "_download_segment",
+                               side_effect=segment, autospec=True):
+            self.assertRaises(exception.ImageDownloadFailed,
+                              self.img._download_segmented, "url",
+                              self.location, self.partial)
+        with open(self.partial, "rb") as f:
+            self.assertEqual(b"x" * 10, f.read())
+        self.assertEqual(["img.part"], os.listdir(self.basedir))
+
+    def test_download_segmented_failed_nothing_written(self):
+        with mock.patch.object(
+                image.HepixImage, "_download_segment",
+                side_effect=exception.ImageDownloadFailed(code=None,
+                                                          reason="")):
+            self.assertRaises(exception.ImageDownloadFailed,
+                              self.img._download_segmented, "url",
+                              self.location, self.partial)
+        self.assertEqual([], os.listdir(self.basedir))
+
+    def _write_partial(self, data):
+        with open(self.partial, "wb") as f:
+            f.write(data)
+
+    def _assert_downloaded(self):
+        with open(self.location, "rb") as f:
+            self.assertEqual(DATA, f.read())
+        self.assertFalse(os.path.exists(self.partial))
+        self.assertEqual(self.location, self.img.location)
+
+    def test_download_resume(self):
+        self._write_partial(DATA[:300])
+        response = FakeResponse(
+            DATA[300:], 206,
+            {"Content-Range": "bytes 300-%d/%d" % (len(DATA) - 1, len(DATA)),
+             "Content-Length": str(len(DATA) - 300)})
+        with mock.patch.object(image.HepixImage, "_get",
+                               return_value=response) as m:
+            self.img.download(self.basedir)
+        m.assert_called_once_with(self.img.uri,
+                                  headers={"Range": "bytes=300-"})
+        self._assert_downloaded()
+
+    def test_download_resume_not_supported(self):
+        self._write_partial(b"x" * 300)
+        responses = [FakeResponse(DATA), FakeResponse(DATA)]
+        with mock.patch.object(image.HepixImage, "_get",
+                               side_effect=responses) as m:
+            self.img.download(self.basedir)
+        self.assertEqual(2, m.call_count)
+        self._assert_downloaded()
+
+    def test_download_resume_wrong_range(self):
+        self._write_partial(DATA[:300])
+        responses = [FakeResponse(DATA[200:], 206,
+                                  {"Content-Range": "bytes 200-"}),
+                     FakeResponse(DATA)]
+        with mock.patch.object(image.HepixImage, "_get",
+                               side_effect=responses):
+            self.img.download(self.basedir)
+        self._assert_downloaded()
+
+    def test_download_resume_not_satisfiable(self):
+        self._write_partial(DATA + b"x")
+        responses = [FakeResponse(b"", 416), FakeResponse(DATA)]
+        with mock.patch.object(image.HepixImage, "_get",
+                               side_effect=responses):
+            self.img.download(self.basedir)
+        self._assert_downloaded()
+
+    def test_download_resume_complete(self):
+        self._write_partial(DATA)
+        with mock.patch.object(image.HepixImage, "_get",
+                               return_value=FakeResponse(b"", 416)) as m:
+            self.img.download(self.basedir)
+        m.assert_called_once_with(
+            self.img.uri, headers={"Range": "bytes=%d-" % len(DATA)})
+        self._assert_downloaded()
+
+    def test_download_resume_checksum_mismatch(self):
+        self._write_partial(b"x" * 300)
+        response = FakeResponse(
+            DATA[300:], 206, {"Content-Range": "bytes 300-"})
+        with mock.patch.object(image.HepixImage, "_get",
+                               return_value=response):
+            self.assertRaises(exception.ImageVerificationFailed,
+                              self.img.download, self.basedir)
+        self.assertEqual([], os.listdir(self.basedir))
+
+    def test_download_larger_than_size(self):
+        response = FakeResponse(DATA + b"x", 200,
+                                {"Content-Length": str(len(DATA) + 1)})
+        with mock.patch.object(image.HepixImage, "_get",
+                               return_value=response):
+            self.assertRaises(exception.ImageDownloadFailed,
+                              self.img.download, self.basedir)
+        self.assertEqual([], os.listdir(self.basedir))
+
+    def test_download_file_resume(self):
+        source = os.path.join(tempfile.mkdtemp(), "img.qcow2")
+        with open(source, "wb") as f:
+            f.write(DATA)
+        self.img.uri = "file://" + source
+        self._write_partial(DATA[:300])
+        self.img.download(self.basedir)
+        self._assert_downloaded()
+
+    def test_download_mirror_failover(self):
+        self.img.mirrors = ["file:///nonexistent/img.qcow2"]
+        with mock.patch.object(image.HepixImage, "_get",
+                               return_value=FakeResponse(DATA)) as m:
+            self.img.download(self.basedir)
+        m.assert_called_once_with(self.img.uri, headers={})
+        self._assert_downloaded()
+        stats = mirrors.get_stats()
+        self.assertEqual(1, stats._get(self.img.mirrors[0])["failures"])
+        self.assertEqual(0, stats._get(self.img.uri)["failures"])
+
+    def test_download_mirror_failover_resume(self):
+        self.img.mirrors = ["https://mirror.example.org/img.qcow2"]
+        self._write_partial(DATA[:300])
+        responses = [FakeResponse(b"", 503),
+                     FakeResponse(DATA[300:], 206,
+                                  {"Content-Range": "bytes 300-"})]
+        with mock.patch.object(image.HepixImage, "_get",
+                               side_effect=responses) as m:
+            self.img.download(self.basedir)
+        self.assertEqual(
+            [mock.call(self.img.mirrors[0], headers={"Range": "bytes=300-"}),
+             mock.call(self.img.uri, headers={"Range": "bytes=300-"})],
+            m.call_args_list)
+        self._assert_downloaded()
+
+    def test_download_mirror_invalid_checksum(self):
+        source = os.path.join(tempfile.mkdtemp(), "img.qcow2")
+        with open(source, "wb") as f:
+            f.write(b"x" * len(DATA))
+        self.img.mirrors = ["file://" + source]
+        with mock.patch.object(image.HepixImage, "_get",
+                               return_value=FakeResponse(DATA)):
+            self.img.download(self.basedir)
+        self._assert_downloaded()
+
+    def test_download_all_mirrors_failed(self):
+        self.img.mirrors = ["file:///nonexistent/img.qcow2"]
+        with mock.patch.object(image.HepixImage, "_get",
+                               return_value=FakeResponse(b"", 404)):
+            self.assertRaises(exception.ImageDownloadFailed,
+                              self.img.download, self.basedir)
+        self.assertIsNone(self.img.location)
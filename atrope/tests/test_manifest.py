@@ -0,0 +1,106 @@
+# -*- coding: utf-8 -*-
+
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import os
+import tempfile
+
+from atrope import exception
+from atrope import manifest
+from atrope.tests import base
+
+
+class TestManifest(base.TestCase):
+
+    def setUp(self):
+        super(TestManifest, self).setUp()
+        self.path = os.path.join(tempfile.mkdtemp(), "manifest.sqlite")
+        self.manifest = manifest.Manifest(self.path)
+
+    def test_list_response_and_verification(self):
+        self.assertIsNone(self.manifest.get_list_response("list"))
+        self.assertIsNone(self.manifest.get_list_verification("list"))
+
+        self.manifest.set_list_response("list", "https://example.org",
+                                        '"etag"', None, b"body")
+        self.assertEqual({"url": "https://example.org", "etag": '"etag"',
+                          "last_modified": None, "body": b"body"},
+                         self.manifest.get_list_response("list"))
+        self.assertIsNone(self.manifest.get_list_verification("list"))
+
+        self.manifest.set_list_verification("list", "digest", "ca",
+                                            {"trusted": True}, b"payload")
+        self.assertEqual({"digest": "digest", "ca_fingerprint": "ca",
+                          "verification": {"trusted": True},
+                          "payload": b"payload"},
+                         self.manifest.get_list_verification("list"))
+        self.assertEqual(b"body",
+                         self.manifest.get_list_response("list")["body"])
+
+    def test_files(self):
+        path = os.path.join(os.path.dirname(self.path), "img")
+        open(path, "wb").close()
+        self.assertIsNone(self.manifest.get_file(path))
+
+        self.manifest.set_file(path, "sha512", 1, 2, 3)
+        row = self.manifest.get_file(path)
+        self.assertEqual(("sha512", 1, 2, 3),
+                         (row["sha512"], row["size"], row["mtime_ns"],
+                          row["inode"]))
+
+        self.manifest.delete_file(path)
+        self.assertIsNone(self.manifest.get_file(path))
+
+    def test_prune_files(self):
+        path = os.path.join(os.path.dirname(self.path), "img")
+        open(path, "wb").close()
+        self.manifest.set_file(path, "sha512", 1, 2, 3)
+        self.manifest.set_file(path + ".old", "sha512", 1, 2, 3)
+        self.manifest.prune_files()
+        self.assertIsNotNone(self.manifest.get_file(path))
+        self.assertIsNone(self.manifest.get_file(path + ".old"))
+
+    def test_processed(self):
+        self.assertEqual({}, self.manifest.get_processed("list", "noop"))
+        processed = {"a": ("1.0", "sha", "config", 10.0),
+                     "b": ("2.0", "sha", "config", 20.0)}
+        self.manifest.set_processed("list", "noop", processed)
+        self.manifest.set_processed("list", "glance", {"a": processed["a"]})
+        self.assertEqual(processed,
+                         self.manifest.get_processed("list", "noop"))
+
+        self.manifest.set_processed("list", "noop", {"b": processed["b"]})
+        self.assertEqual({"b": processed["b"]},
+                         self.manifest.get_processed("list", "noop"))
+        self.assertEqual({"a": processed["a"]},
+                         self.manifest.get_processed("list", "glance"))
+
+    def test_mirrors(self):
+        self.assertEqual({}, self.manifest.get_mirrors())
+        self.manifest.set_mirror("https://a.org", None, 1, 10.0)
+        self.manifest.set_mirror("https://a.org", 100.0, 0, 10.0)
+        self.assertEqual({"https://a.org": {"throughput": 100.0,
+                                            "failures": 0,
+                                            "failed_at": 10.0}},
+                         self.manifest.get_mirrors())
+
+    def test_reopen(self):
+        self.manifest.set_mirror("https://a.org", None, 1, 10.0)
+        other = manifest.Manifest(self.path)
+        self.assertIn("https://a.org", other.get_mirrors())
+
+    def test_invalid_database(self):
+        path = os.path.join(os.path.dirname(self.path), "invalid.sqlite")
+        with open(path, "wb") as f:
+            f.write(b"not a database" * 100)
+        self.assertRaises(exception.ManifestError, manifest.Manifest, path)
@@ -0,0 +1,112 @@
+# -*- coding: utf-8 -*-
+
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import tempfile
+from unittest import mock
+
+import fixtures
+from oslo_config import cfg
+from oslo_config import fixture as config_fixture
+
+from atrope import manifest
+from atrope import mirrors
+from atrope.tests import base
+
+CONF = cfg.CONF
+
+
+class TestMirrorUrls(base.TestCase):
+
+    def setUp(self):
+        super(TestMirrorUrls, self).setUp()
+        self.conf = self.useFixture(config_fixture.Config(CONF))
+
+    def test_no_rules(self):
+        self.assertEqual([], mirrors.get_mirror_urls("https://a.org/img"))
+
+    def test_conf_rules(self):
+        self.conf.config(mirror=["https://a.org/=https://m1.org/a/",
+                                 "invalid",
+                                 "https://b.org/=https://m2.org/"],
+                         group="http")
+        self.assertEqual(["https://m1.org/a/img"],
+                         mirrors.get_mirror_urls("https://a.org/img"))
+
+    def test_longest_prefix_first(self):
+        self.conf.config(mirror=["https://a.org/=https://m1.org/",
+                                 "https://a.org/x/=file:///mirror/"],
+                         group="http")
+        rules = {"https://a.org/": ["https://m2.org/", "https://m1.org/"]}
+        self.assertEqual(["file:///mirror/img",
+                          "https://m2.org/x/img",
+                          "https://m1.org/x/img"],
+                         mirrors.get_mirror_urls("https://a.org/x/img",
+                                                 rules))
+
+    def test_same_url_ignored(self):
+        rules = {"https://a.org/": "https://a.org/"}
+        self.assertEqual([],
+                         mirrors.get_mirror_urls("https://a.org/img", rules))
+
+
+class TestMirrorStats(base.TestCase):
+
+    def setUp(self):
+        super(TestMirrorStats, self).setUp()
+        self.conf = self.useFixture(config_fixture.Config(CONF))
+        self.conf.config(state_path=tempfile.mkdtemp())
+        self.conf.config(mirror_error_cooldown=100, group="http")
+        self.useFixture(fixtures.MonkeyPatch("atrope.manifest._MANIFEST",
+                                             None))
+        self.stats = mirrors.MirrorStats(manifest.get_manifest())
+
+    def test_sort_unmeasured_first(self):
+        size = mirrors._MIN_SAMPLE
+        self.stats.record_success("https://slow.org/img", size, 10)
+        self.stats.record_success("https://fast.org/img", size, 1)
+        self.assertEqual(["https://new.org/img",
+                          "https://fast.org/img",
+                          "https://slow.org/img"],
+                         self.stats.sort(["https://slow.org/img",
+                                          "https://fast.org/img",
+                                          "https://new.org/img"]))
+
+    def test_small_downloads_not_measured(self):
+        self.stats.record_success("https://a.org/img", 1, 10)
+        self.assertIsNone(self.stats._get("https://a.org/x")["throughput"])
+
+    def test_failure_cooldown(self):
+        urls = ["https://a.org/img", "https://b.org/img"]
+        with mock.patch("time.time", return_value=1000):
+            self.stats.record_failure(urls[0])
+            self.assertEqual(urls[::-1], self.stats.sort(urls))
+        with mock.patch("time.time", return_value=1100):
+            self.assertEqual(urls, self.stats.sort(urls))
+            # The cooldown is doubled for each consecutive failure
+            self.stats.record_failure(urls[0])
+        with mock.patch("time.time", return_value=1200):
+            self.assertEqual(urls[::-1], self.stats.sort(urls))
+        with mock.patch("time.time", return_value=1300):
+            self.assertEqual(urls, self.stats.sort(urls))
+
+        self.stats.record_success(urls[0], 1, 1)
+        self.assertEqual(0, self.stats._get(urls[0])["failures"])
+
+    def test_persisted(self):
+        self.stats.record_success("https://a.org/img", mirrors._MIN_SAMPLE, 1)
+        self.stats.record_failure("https://b.org/img")
+        stats = mirrors.MirrorStats(manifest.get_manifest())
+        self.assertEqual(mirrors._MIN_SAMPLE,
+                         stats._get("https://a.org/")["throughput"])
+        self.assertEqual(1, stats._get("https://b.org/")["failures"])
@@ -0,0 +1,152 @@
+# -*- coding: utf-8 -*-
+
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import datetime
+import os
+import tempfile
+
+from cryptography.hazmat.primitives.asymmetric import rsa
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.serialization import pkcs7
+from cryptography import x509
+from cryptography.x509.oid import ExtendedKeyUsageOID
+from cryptography.x509.oid import NameOID
+import fixtures
+import OpenSSL
+from oslo_config import cfg
+from oslo_config import fixture as config_fixture
+
+from atrope import exception
+from atrope import smime
+from atrope.tests import base
+
+CONF = cfg.CONF
+
+PAYLOAD = b'{"hv:imagelist": {}}'
+
+
+def _name(cn):
+    return x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, cn)])
+
+
+def _make_cert(cn, issuer=None, ca=False, eku=None, days=1):
+    key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    now = datetime.datetime.now(datetime.timezone.utc)
+    if issuer is None:
+        issuer_name, issuer_key = _name(cn), key
+    else:
+        issuer_name, issuer_key = issuer[0].subject, issuer[1]
+    builder = x509.CertificateBuilder().subject_name(
+        _name(cn)
+    ).issuer_name(
+        issuer_name
+    ).public_key(
+        key.public_key()
+    ).serial_number(
+        x509.random_serial_number()
+    ).not_valid_before(
+        now - datetime.timedelta(days=1)
+    ).not_valid_after(
+        now + datetime.timedelta(days=days)
+    ).add_extension(
+        x509.BasicConstraints(ca=ca, path_length=None), critical=True
+    )
+    if ca:
+        builder = builder.add_extension(
+            x509.KeyUsage(digital_signature=True, content_commitment=False,
+                          key_encipherment=False, data_encipherment=False,
+                          key_agreement=False, key_cert_sign=True,
+                          crl_sign=True, encipher_only=False,
+                          decipher_only=False),
+            critical=True)
+    if eku is not None:
+        builder = builder.add_extension(x509.ExtendedKeyUsage(eku),
+                                        critical=False)
+    return builder.sign(issuer_key, hashes.SHA256()), key
+
+
+def _sign(signer, detached=True):
+    options = [pkcs7.PKCS7Options.DetachedSignature] if detached else []
+    return pkcs7.PKCS7SignatureBuilder().set_data(
+        PAYLOAD
+    ).add_signer(
+        signer[0], signer[1], hashes.SHA256()
+    ).sign(serialization.Encoding.SMIME, options)
+
+
+class _TestSMIMEVerifier(object):
+
+    backend = None
+
+    def setUp(self):
+        super(_TestSMIMEVerifier, self).setUp()
+        self.ca = _make_cert("TestCA", ca=True, days=2)
+
+        ca_path = tempfile.mkdtemp()
+        hash_name = "%08x.0" % OpenSSL.crypto.X509.from_cryptography(
+            self.ca[0]).subject_name_hash()
+        with open(os.path.join(ca_path, hash_name), "wb") as f:
+            f.write(self.ca[0].public_bytes(serialization.Encoding.PEM))
+
+        self.conf = self.useFixture(config_fixture.Config(CONF))
+        self.conf.config(ca_path=ca_path, smime_backend=self.backend)
+        self.useFixture(fixtures.MonkeyPatch("atrope.smime._STORE", None))
+
+    def test_verify(self):
+        for eku in (None, [ExtendedKeyUsageOID.EMAIL_PROTECTION]):
+            signer = _make_cert("signer", issuer=self.ca, eku=eku)
+            for detached in (True, False):
+                msg = _sign(signer, detached=detached)
+                verified, content = smime.SMIMEVerifier().verify(msg)
+                self.assertEqual("/CN=signer", verified.dn)
+                self.assertEqual("/CN=TestCA", verified.ca)
+                self.assertEqual(PAYLOAD, content.replace(b"\r\n", b"\n"))
+
+    def test_verify_not_after(self):
+        signer = _make_cert("signer", issuer=self.ca, days=3)
+        verified, _ = smime.SMIMEVerifier().verify(_sign(signer))
+        self.assertEqual(self.ca[0].not_valid_after_utc.timestamp(),
+                         verified.not_after)
+        self.assertFalse(verified.is_expired())
+
+    def test_verify_tampered(self):
+        signer = _make_cert("signer", issuer=self.ca)
+        msg = _sign(signer).replace(b"imagelist", b"imageLIST")
+        self.assertRaises(exception.SMIMEValidationError,
+                          smime.SMIMEVerifier().verify, msg)
+
+    def test_verify_unknown_ca(self):
+        other_ca = _make_cert("OtherCA", ca=True)
+        signer = _make_cert("signer", issuer=other_ca)
+        self.assertRaises(exception.SMIMEValidationError,
+                          smime.SMIMEVerifier().verify, _sign(signer))
+
+    def test_verify_wrong_purpose(self):
+        signer = _make_cert("signer", issuer=self.ca,
+                            eku=[ExtendedKeyUsageOID.SERVER_AUTH])
+        self.assertRaises(exception.SMIMEValidationError,
+                          smime.SMIMEVerifier().verify, _sign(signer))
+
+
+class TestNativeSMIMEVerifier(_TestSMIMEVerifier, base.TestCase):
+    backend = "native"
+
+    def test_verify_does_not_fall_back(self):
+        signer = _make_cert("signer", issuer=self.ca)
+        self.assertIsNotNone(smime.NativeVerifier().verify(_sign(signer)))
+
+
+class TestOpenSSLSMIMEVerifier(_TestSMIMEVerifier, base.TestCase):
+    backend = "openssl"
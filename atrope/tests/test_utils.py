@@ -0,0 +1,29 @@
+# -*- coding: utf-8 -*-
+
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import os
+import tempfile
+
+from atrope.tests import base
+from atrope import utils
+
+
+class TestUtils(base.TestCase):
+
+    def test_preallocate_keeps_size(self):
+        with tempfile.TemporaryFile() as f:
+            f.write(b"x" * 10)
+            f.flush()
+            utils.preallocate(f.fileno(), 1024 * 1024)
+            self.assertEqual(10, os.fstat(f.fileno()).st_size)
@@ -14,16 +14,40 @@
 # License for the specific language governing permissions and limitations
 # under the License.
 
+import contextlib
+import ctypes
+import ctypes.util
 import errno
+import fcntl
 import hashlib
 import os
 import os.path
 import shutil
+import threading
+import time
 
 import prettytable
 import six
 from six.moves import input
 
+# NOTE: fallocate(2) flag, not exposed by the os module
+FALLOC_FL_KEEP_SIZE = 0x01
+
+
+def _load_fallocate():
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        fallocate = getattr(libc, "fallocate64", None) or libc.fallocate
+    except (OSError, AttributeError):
+        return None
+    fallocate.argtypes = [ctypes.c_int, ctypes.c_int,
+                          ctypes.c_int64, ctypes.c_int64]
+    fallocate.restype = ctypes.c_int
+    return fallocate
+
+
+_fallocate = _load_fallocate()
+
 
 def print_list(objs, fields, sortby=None):
     pt = prettytable.PrettyTable([f for f in fields], caching=False)
@@ -103,15 +127,87 @@ def makedirs(path):
             raise
 
 
-def get_file_checksum(path):
+@contextlib.contextmanager
+def file_lock(path, shared=False, timeout=None):
+    """Hold an advisory lock on a file, creating it if needed.
+
+    The lock is taken with flock(), so it is held by the open file and two
+    threads of the same process do exclude each other.
+
+    :param path: File to lock
+    :param shared: Take a shared lock instead of an exclusive one
+    :param timeout: Seconds to wait for the lock, None to wait indefinitely
+    :returns: a context manager that yields True if the lock was acquired
+              or False if the timeout expired.
+    """
+    operation = fcntl.LOCK_SH if shared else fcntl.LOCK_EX
+    fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+    try:
+        if timeout is None:
+            fcntl.flock(fd, operation)
+            locked = True
+        else:
+            deadline = time.monotonic() + timeout
+            while True:
+                try:
+                    fcntl.flock(fd, operation | fcntl.LOCK_NB)
+                    locked = True
+                    break
+                except BlockingIOError:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        locked = False
+                        break
+                    time.sleep(min(remaining, 1))
+        yield locked
+    finally:
+        os.close(fd)
+
+
+def preallocate(fd, size):
+    """Preallocate disk space for a file, without changing its size.
+
+    The file size is not modified, so a file that is being written is never
+    seen larger than the data written into it, even if the process is
+    killed. Nothing is done if the platform or the filesystem do not support
+    it.
+
+    :param fd: File descriptor
+    :param size: Size of the file, in bytes
+    """
+    if _fallocate is None:
+        return
+    if _fallocate(fd, FALLOC_FL_KEEP_SIZE, 0, size) != 0:
+        err = ctypes.get_errno()
+        if err in (errno.EOPNOTSUPP, errno.EINVAL, errno.ENOSYS):
+            return
+        raise OSError(err, os.strerror(err))
+
+
+def read_blocks(f, block_size):
+    """Read a binary file-like object in blocks, reusing the same buffer.
+
+    The yielded blocks are memoryviews over the buffer, therefore they are
+    only valid until the next block is read.
+
+    :param f: File-like object implementing readinto()
+    :param block_size: Size of the buffer
+    """
+    buf = bytearray(block_size)
+    view = memoryview(buf)
+    while True:
+        n = f.readinto(buf)
+        if not n:
+            break
+        yield view[:n]
+
+
+def get_file_checksum(path, block_size=1024 * 1024):
     sha512 = hashlib.sha512()
-    block_size = sha512.block_size
 
     with open(path, "rb") as f:
-        buf = f.read(block_size)
-        while len(buf) > 0:
-            sha512.update(buf)
-            buf = f.read(block_size)
+        for block in read_blocks(f, block_size):
+            sha512.update(block)
     return sha512
 
 
@@ -132,10 +228,13 @@ def yn_question(msg="Enabled", default=True):
 
 
 def run_once(f):
+    lock = threading.Lock()
+
     def wrapper(*args, **kwargs):
-        if not wrapper.has_run:
-            wrapper.has_run = True
-            return f(*args, **kwargs)
+        with lock:
+            if not wrapper.has_run:
+                wrapper.has_run = True
+                return f(*args, **kwargs)
     wrapper.has_run = False
     return wrapper
 